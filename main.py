@@ -3,7 +3,7 @@ from fastapi import FastAPI, HTTPException, Depends
 
 from src.database.db import get_db
 
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
@@ -12,12 +12,35 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.routes import auth, images
+from src.routes import auth, images, tags, comments
+from src.services.auth import auth_service
+from src.services.body_limit import BodySizeLimitMiddleware
+from src.services.image import derivative_engine
+from src.services.metrics import MetricsMiddleware, metrics_response
+from src.services.query_budget import QueryBudgetMiddleware
+from src.conf.config import settings
 
-app = FastAPI(title="PhotoShare")
+app = FastAPI(title="PhotoShare", default_response_class=ORJSONResponse)
+# Multipart bodies are spooled whole before a route runs, so oversized uploads are stopped here
+upload_body_limit = settings.max_image_size + settings.upload_form_overhead
+app.add_middleware(BodySizeLimitMiddleware, limits={
+    '/api/images/upload': upload_body_limit,
+    '/api/images/upload_batch': upload_body_limit * settings.max_batch_files,
+})
+app.add_middleware(MetricsMiddleware)
+if settings.query_budget_enabled:
+    app.add_middleware(QueryBudgetMiddleware)
 
 app.include_router(auth.router, prefix="/api")
 app.include_router(images.router, prefix="/api")
+app.include_router(tags.router, prefix="/api")
+app.include_router(comments.router, prefix="/api")
+
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    auth_service.shutdown_hash_executor()
+    derivative_engine.shutdown_executor()
 
 
 @app.get("/")
@@ -25,6 +48,11 @@ def index():
     return {"message": "PhotoShare Application"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return metrics_response()
+
+
 @app.get("/api/healthchecker")
 async def healthchecker(db: AsyncSession = Depends(get_db)):
     try:
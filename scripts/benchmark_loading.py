@@ -0,0 +1,82 @@
+# Compare relationship loading strategies per endpoint query: rows fetched and wall time.
+#
+#   python -m scripts.benchmark_loading --tag beach --limit 100 --repeat 20
+#
+# "before" reproduces the old lazy="joined" chain (image -> owner, tags -> tag.images),
+# "after" uses the loader options the repository applies now.
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import joinedload
+
+from src.database.db import sessionmanager
+from src.models.models import Image, Tag
+from src.repository.images import IMAGE_LIST_OPTIONS, IMAGE_FILE_OPTIONS
+
+BEFORE_IMAGE_OPTIONS = (joinedload(Image.owner), joinedload(Image.tags).joinedload(Tag.images))
+BEFORE_TAG_OPTIONS = (joinedload(Tag.images).joinedload(Image.owner), joinedload(Tag.images).joinedload(Image.tags))
+
+
+def endpoint_queries(tag: Tag | None, limit: int):
+    queries = {
+        'images_all': (select(Image).limit(limit), BEFORE_IMAGE_OPTIONS, IMAGE_LIST_OPTIONS),
+        'download': (select(Image).limit(1), BEFORE_IMAGE_OPTIONS, IMAGE_FILE_OPTIONS),
+    }
+    if tag is not None:
+        queries['tag_lookup'] = (select(Tag).filter_by(id=tag.id), BEFORE_TAG_OPTIONS, ())
+        queries['images_by_tag'] = (select(Image).filter(Image.tags.contains(tag)).limit(limit),
+                                    BEFORE_IMAGE_OPTIONS, IMAGE_LIST_OPTIONS)
+    return queries
+
+
+async def measure(query, repeat: int):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    engine = sessionmanager._engine.sync_engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            async with sessionmanager.session() as session:
+                result = await session.execute(query)
+                result.unique().scalars().all()
+        elapsed = (time.perf_counter() - started) / repeat
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    # Re-run the captured SQL of a single pass to count the raw rows sent by the database
+    per_pass = statements[:len(statements) // repeat]
+    rows = 0
+    async with sessionmanager._engine.connect() as conn:
+        for statement, parameters in per_pass:
+            result = await conn.exec_driver_sql(statement, parameters)
+            rows += len(result.fetchall())
+    return len(per_pass), rows, elapsed
+
+
+async def main(tag_name: str | None, limit: int, repeat: int):
+    async with sessionmanager.session() as session:
+        tag = None
+        if tag_name:
+            result = await session.execute(select(Tag).filter_by(name=tag_name))
+            tag = result.scalar_one_or_none()
+
+    print(f"{'endpoint':<16}{'strategy':<10}{'queries':>8}{'rows':>12}{'ms':>10}")
+    for name, (query, before, after) in endpoint_queries(tag, limit).items():
+        for strategy, options in (('before', before), ('after', after)):
+            statements, rows, elapsed = await measure(query.options(*options), repeat)
+            print(f"{name:<16}{strategy:<10}{statements:>8}{rows:>12}{elapsed * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tag', help='Tag name to benchmark tag lookups with')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.tag, args.limit, args.repeat))
@@ -0,0 +1,80 @@
+# Compare listing serialization paths on in-memory data, no database needed.
+#
+#   python -m scripts.benchmark_serialization --sizes 10 100 500 --owners 20 --repeat 200
+#
+# "models" is the response_model path: ImageReadSchema from ORM objects, validated again for
+# response_model and encoded with the stdlib JSON encoder. "rows" is dump_image_rows over plain rows.
+import argparse
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import List
+
+import orjson
+from pydantic import TypeAdapter
+from starlette.responses import JSONResponse
+
+from src.models.models import Image, User, Role
+from src.schemas.images import ImageReadSchema
+from src.services.serialization import dump_image_rows
+
+ImageRow = namedtuple('ImageRow', ['id', 'title', 'image_path', 'mime_type', 'created_at', 'updated_at', 'count_tags',
+                                   'comment_count', 'owner_id', 'owner_email', 'owner_username', 'owner_avatar',
+                                   'owner_role'])
+image_list_adapter = TypeAdapter(List[ImageReadSchema])
+
+
+def make_data(size: int, owner_count: int):
+    owners = [User(id=uuid.uuid4(), email=f'user{index}@example.com', username=f'user{index}',
+                   avatar=f'https://www.gravatar.com/avatar/{index:032x}', role=Role.user)
+              for index in range(owner_count)]
+    started = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    images, rows = [], []
+    for index in range(size):
+        owner = owners[index % owner_count]
+        created_at = started + timedelta(minutes=index)
+        fields = {'id': index + 1, 'title': f'Image {index}', 'image_path': f'uploaded_files/{index:064x}.jpg',
+                  'mime_type': 'image/jpeg', 'created_at': created_at, 'updated_at': created_at,
+                  'count_tags': index % 5, 'comment_count': index % 7}
+        images.append(Image(**fields, owner_id=owner.id, owner=owner))
+        rows.append(ImageRow(**fields, owner_id=owner.id, owner_email=owner.email, owner_username=owner.username,
+                             owner_avatar=owner.avatar, owner_role=owner.role))
+    return images, rows
+
+
+def models_path(images) -> bytes:
+    validated = image_list_adapter.validate_python(images, from_attributes=True)
+    content = image_list_adapter.dump_python(image_list_adapter.validate_python(validated), mode='json')
+    return JSONResponse(content).body
+
+
+def rows_path(rows) -> bytes:
+    return dump_image_rows(rows)
+
+
+def measure(func, data, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(data)
+    return (time.perf_counter() - started) / repeat
+
+
+def main(sizes: list[int], owner_count: int, repeat: int):
+    print(f"{'items':>6}{'models ms':>12}{'rows ms':>10}{'speedup':>9}{'bytes':>9}")
+    for size in sizes:
+        images, rows = make_data(size, owner_count)
+        assert orjson.loads(models_path(images)) == orjson.loads(rows_path(rows)), 'paths disagree'
+        models_time = measure(models_path, images, repeat)
+        rows_time = measure(rows_path, rows, repeat)
+        print(f"{size:>6}{models_time * 1000:>12.3f}{rows_time * 1000:>10.3f}{models_time / rows_time:>8.1f}x"
+              f"{len(rows_path(rows)):>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--owners', type=int, default=20, help='Distinct owners across a page')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    main(args.sizes, args.owners, args.repeat)
@@ -0,0 +1,99 @@
+# Compare tag expression filters on the /images/tag query: wall time per page and the plan chosen.
+#
+#   python -m scripts.benchmark_tag_filter --expression beach --expression "beach AND sunset NOT night" \
+#       --limit 10 --pages 5 --repeat 20 --explain
+#
+# "group_by" reproduces the old Image.id IN (GROUP BY ... HAVING count = n) filter, which aggregates every
+# association of the requested tags on each page; "exists" is the correlated EXISTS filter used now.
+# Run it against a copy of production data: the gap grows with the number of images carrying the tags.
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select, func, union, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import aliased
+
+from src.database.db import sessionmanager
+from src.models.models import Image, ImageTagAssociation, Tag
+from src.repository.images import images_matching_tags, parse_tag_expression, paginate, encode_cursor
+
+
+def group_by_filter(groups: list[tuple[list[str], list[str]]]):
+    selects = []
+    for required, excluded in groups:
+        if required:
+            query = (select(ImageTagAssociation.image_id.label('image_id'))
+                     .join(Tag, Tag.id == ImageTagAssociation.tag_id)
+                     .filter(Tag.name.in_(required))
+                     .group_by(ImageTagAssociation.image_id)
+                     .having(func.count(Tag.id) == len(set(required))))
+            image_id = ImageTagAssociation.image_id
+        else:
+            query = select(Image.id.label('image_id'))
+            image_id = Image.id
+        if excluded:
+            excluded_association = aliased(ImageTagAssociation)
+            excluded_tag = aliased(Tag)
+            query = query.filter(~select(excluded_association.id)
+                                 .join(excluded_tag, excluded_tag.id == excluded_association.tag_id)
+                                 .filter(excluded_association.image_id == image_id)
+                                 .filter(excluded_tag.name.in_(excluded))
+                                 .exists())
+        selects.append(query)
+    return Image.id.in_(selects[0] if len(selects) == 1 else union(*selects))
+
+
+STRATEGIES = {'group_by': group_by_filter, 'exists': images_matching_tags}
+
+
+# Walk pages with the keyset cursor like a client would; milliseconds per page, averaged over repeats
+async def measure(condition, limit: int, pages: int, repeat: int) -> tuple[list[float], int]:
+    timings = [0.0] * pages
+    rows = 0
+    for _ in range(repeat):
+        cursor = None
+        rows = 0
+        async with sessionmanager.session() as session:
+            for page in range(pages):
+                query = paginate(select(Image.id, Image.created_at).filter(condition), limit, 0, cursor)
+                started = time.perf_counter()
+                result = await session.execute(query)
+                page_rows = result.all()
+                timings[page] += time.perf_counter() - started
+                rows += len(page_rows)
+                if len(page_rows) < limit:
+                    break
+                cursor = encode_cursor(page_rows[-1])
+    return [timing / repeat * 1000 for timing in timings], rows
+
+
+async def explain(condition, limit: int):
+    query = paginate(select(Image.id).filter(condition), limit, 0)
+    sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+    async with sessionmanager.session() as session:
+        result = await session.execute(text(f'EXPLAIN (ANALYZE, BUFFERS) {sql}'))
+        for line in result.scalars():
+            print(f'    {line}')
+
+
+async def main(expressions: list[str], limit: int, pages: int, repeat: int, show_plan: bool):
+    print(f"{'expression':<40}{'strategy':<10}{'rows':>8}  ms per page")
+    for expression in expressions:
+        groups = parse_tag_expression(expression)
+        for strategy, build in STRATEGIES.items():
+            timings, rows = await measure(build(groups), limit, pages, repeat)
+            print(f"{expression:<40}{strategy:<10}{rows:>8}  " + ' '.join(f'{ms:.2f}' for ms in timings))
+            if show_plan:
+                await explain(build(groups), limit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expression', action='append', required=True, help='Tag expression, repeatable')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--explain', action='store_true', help='Print EXPLAIN ANALYZE of the first page')
+    args = parser.parse_args()
+    asyncio.run(main(args.expression, args.limit, args.pages, args.repeat, args.explain))
@@ -0,0 +1,31 @@
+# Deliver queued emails: pooled SMTP connections, batches, retries with backoff, dead letters in mail:dead.
+#
+#   python -m scripts.email_worker --name worker-1
+#
+# Use a distinct --name per running worker: its unfinished jobs are requeued when a worker
+# with the same name starts. To test locally against an SMTP sink that prints every message:
+#
+#   python -m aiosmtpd -n -l localhost:1025
+#   MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_SSL_TLS=false MAIL_USE_CREDENTIALS=false python -m scripts.email_worker
+import argparse
+import asyncio
+import signal
+import socket
+
+from src.services.email_worker import EmailWorker
+
+
+async def main(name: str):
+    worker = EmailWorker(name)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stopping.set)
+    print(f"Email worker {name} started")
+    await worker.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default=socket.gethostname())
+    args = parser.parse_args()
+    asyncio.run(main(args.name))
@@ -0,0 +1,92 @@
+# Copy every stored file (blobs, their variants, images saved before dedup) from one storage backend to another.
+#
+#   python -m scripts.migrate_storage --source local --target s3 --concurrency 8
+#
+# Keys stay the same, so after the copy only STORAGE_BACKEND has to change. Objects already in the
+# target are skipped, which makes the command safe to re-run; --delete-source removes each copied file.
+import argparse
+import asyncio
+
+from sqlalchemy import select
+
+from src.database.db import sessionmanager
+from src.models.models import Image, ImageBlob, ImageVariant
+from src.services.storage import Storage, create_storage, make_temp_file, discard_file
+
+BATCH_SIZE = 500
+
+
+# (key, mime type) of every stored file, keyset paginated per table
+async def stored_files():
+    for key_column, mime_column, condition in ((ImageBlob.path, ImageBlob.mime_type, None),
+                                               (ImageVariant.path, ImageVariant.mime_type, None),
+                                               (Image.image_path, Image.mime_type, Image.content_hash.is_(None))):
+        after = None
+        while True:
+            query = select(key_column, mime_column)
+            if condition is not None:
+                query = query.filter(condition)
+            if after is not None:
+                query = query.filter(key_column > after)
+            async with sessionmanager.session() as db:
+                result = await db.execute(query.order_by(key_column).limit(BATCH_SIZE))
+                rows = result.all()
+            for row in rows:
+                yield row
+            if len(rows) < BATCH_SIZE:
+                break
+            after = rows[-1][0]
+
+
+async def copy(key: str, mime_type: str, source: Storage, target: Storage, delete_source: bool) -> str:
+    if await target.exists(key):
+        return 'skipped'
+    tmp_path = await make_temp_file()
+    try:
+        await source.download(key, tmp_path)
+        await target.put(key, tmp_path, mime_type)
+    except FileNotFoundError:
+        return 'missing'
+    finally:
+        discard_file(tmp_path)
+    if delete_source:
+        await source.delete(key)
+    return 'copied'
+
+
+async def main(source_name: str, target_name: str, concurrency: int, delete_source: bool):
+    source, target = create_storage(source_name), create_storage(target_name)
+    semaphore = asyncio.Semaphore(concurrency)
+    outcomes = {'copied': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+
+    async def migrate(key: str, mime_type: str):
+        async with semaphore:
+            try:
+                outcome = await copy(key, mime_type, source, target, delete_source)
+            except Exception as err:
+                print(f"{key}: {err}")
+                outcome = 'failed'
+            if outcome == 'missing':
+                print(f"{key}: not found in {source.name}")
+            outcomes[outcome] += 1
+
+    tasks = set()
+    async for key, mime_type in stored_files():
+        task = asyncio.create_task(migrate(key, mime_type))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        if len(tasks) >= concurrency * 4:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    if tasks:
+        await asyncio.wait(tasks)
+    print(', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', required=True, choices=['local', 's3', 'cloudinary'])
+    parser.add_argument('--target', required=True, choices=['local', 's3', 'cloudinary'])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--delete-source', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(main(args.source, args.target, args.concurrency, args.delete_source))
@@ -0,0 +1,24 @@
+# Rebuild image derivatives made with outdated presets, e.g. after DERIVATIVE_PRESETS changed.
+#
+#   python -m scripts.regenerate_variants --batch-size 100
+import argparse
+import asyncio
+
+from src.database.db import sessionmanager
+from src.services.image import derivative_engine, PRESETS_VERSION
+
+
+async def main(batch_size: int):
+    try:
+        async with sessionmanager.session() as db:
+            processed = await derivative_engine.regenerate_outdated(db, batch_size)
+        print(f"Processed {processed} blobs for presets version {PRESETS_VERSION}")
+    finally:
+        derivative_engine.shutdown_executor()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
@@ -0,0 +1,46 @@
+# Fire parallel add_tag_to_image calls at one image and check count_tags stays exact and within MAX_ADD_TAGS.
+#
+#   python -m scripts.stress_add_tag --image-id 1 --requests 50
+import argparse
+import asyncio
+
+from fastapi import HTTPException
+from sqlalchemy import select, func
+
+from src.conf.config import settings
+from src.database.db import sessionmanager
+from src.models.models import Image, ImageTagAssociation
+from src.repository import images as repository_images
+
+
+async def add_tag(image_id: int, tag_name: str) -> str:
+    async with sessionmanager.session() as db:
+        try:
+            image = await repository_images.add_tag_to_image(image_id, tag_name, db)
+        except HTTPException as err:
+            return err.detail
+        return 'added' if image else 'image not found'
+
+
+async def main(image_id: int, requests: int, distinct_tags: int):
+    tag_names = [f'stress-{index % distinct_tags}' for index in range(requests)]
+    outcomes = await asyncio.gather(*[add_tag(image_id, name) for name in tag_names])
+    for outcome in sorted(set(outcomes)):
+        print(f'{outcomes.count(outcome):>5}  {outcome}')
+
+    async with sessionmanager.session() as db:
+        count_tags = await db.scalar(select(Image.count_tags).filter_by(id=image_id))
+        associations = await db.scalar(select(func.count(ImageTagAssociation.id)).filter_by(image_id=image_id))
+    print(f'count_tags={count_tags} associations={associations} max={settings.max_add_tags}')
+    if count_tags != associations or associations > settings.max_add_tags:
+        raise SystemExit('FAILED: count_tags is out of sync or over the limit')
+    print('OK')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image-id', type=int, required=True)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--distinct-tags', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.image_id, args.requests, args.distinct_tags))
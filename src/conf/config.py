@@ -5,16 +5,44 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8')
     db_url: str
     db_local_url: str
+    db_replica_urls: str = ''
+    replica_max_lag: float = 5.0
+    replica_check_interval: float = 5.0
+    read_your_writes_seconds: int = 5
+    query_budget_enabled: bool = False
+    query_budget_mode: str = 'log'
+    query_budget: int = 20
+    query_budgets: dict[str, int] = {}
+    query_budget_repeats: int = 3
     secret_key: str
     algorithm: str
+    token_cache_size: int = 10000
+    password_hash_executor: str = 'process'
+    password_hash_workers: int = 0
+    password_hash_queue_size: int = 32
+    password_hash_retry_after: int = 1
     mail_username: str
     mail_password: str
     mail_from: str
     mail_port: int
     mail_server: str
+    mail_ssl_tls: bool = True
+    mail_starttls: bool = False
+    mail_use_credentials: bool = True
+    mail_batch_size: int = 20
+    mail_smtp_connections: int = 2
+    mail_smtp_idle_timeout: int = 60
+    mail_smtp_acquire_timeout: int = 60
+    mail_max_attempts: int = 5
+    mail_retry_base: int = 30
+    mail_retry_max: int = 3600
     redis_host: str
     redis_local_host: str = 'localhost'
     redis_port: int = '6379'
+    user_cache_ttl: int = 300
+    rate_limit_login: str = '10/60'
+    rate_limit_signup: str = '5/3600'
+    rate_limit_upload: str = '60/60'
     db_admin: str
     db_password: str
     db_port: str
@@ -24,8 +52,33 @@ class Settings(BaseSettings):
     cloudinary_api_secret: str
     cloudinary_url: str
     uploaded_files_path: str
+    storage_backend: str = 'local'
+    storage_multipart_chunk_size: int = 8 * 1024 * 1024
+    storage_max_concurrency: int = 8
+    storage_presign_expires: int = 3600
+    storage_presigned_downloads: bool = True
+    s3_bucket: str = ''
+    s3_endpoint_url: str = ''
+    s3_region: str = ''
+    s3_access_key: str = ''
+    s3_secret_key: str = ''
+    file_offload: str = ''
+    file_offload_prefix: str = '/protected/'
+    signed_url_secret: str = ''
+    signed_url_expires: int = 3600
+    signed_url_prefix: str = '/api/images/files/'
     max_image_size: int
+    upload_chunk_size: int = 1024 * 1024
+    upload_form_overhead: int = 64 * 1024
+    image_workers: int = 0
+    upload_concurrency: int = 4
+    max_batch_files: int = 200
+    image_cache_control: str = 'public, max-age=86400'
+    response_cache_ttl: int = 30
+    response_cache_stale: int = 300
+    response_cache_lock_timeout: int = 5
     max_add_tags: int
+    max_expression_tags: int = 20
 
 
 settings = Settings()
@@ -1,21 +1,79 @@
 import contextlib
-import redis.asyncio as redis_async
+import hashlib
+import itertools
+import time
+
+from fastapi import Request
+from redis.exceptions import RedisError
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 
 from src.conf.config import settings
+from src.services.metrics import InstrumentedRedis, TimedQueuePool, instrument_engine
+from src.services.query_budget import track_queries
+
+# Seconds the replica is behind the primary; 0 on a primary or a replica that replayed all it received
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class Replica:
+    def __init__(self, url: str, name: str):
+        self.url = url
+        self.engine: AsyncEngine = create_async_engine(url, pool_pre_ping=True, poolclass=TimedQueuePool)
+        instrument_engine(self.engine.sync_engine, name)
+        track_queries(self.engine.sync_engine)
+        self.session_maker: async_sessionmaker = async_sessionmaker(autoflush=False, autocommit=False,
+                                                                    expire_on_commit=False, bind=self.engine)
+        self._available = True
+        self._checked_at = 0.0
+
+    # Lag and reachability are checked at most once per replica_check_interval
+    async def is_available(self) -> bool:
+        if time.monotonic() - self._checked_at < settings.replica_check_interval:
+            return self._available
+        self._checked_at = time.monotonic()
+        try:
+            async with self.engine.connect() as connection:
+                lag = await connection.scalar(REPLICA_LAG_QUERY)
+            self._available = lag <= settings.replica_max_lag
+        except Exception as err:
+            print(err)
+            self._available = False
+        return self._available
 
 
 class DatabaseSessionManager:
-    def __init__(self, url: str):
-        self._engine: AsyncEngine | None = create_async_engine(url)
+    def __init__(self, url: str, replica_urls: list[str] | None = None):
+        self._engine: AsyncEngine | None = create_async_engine(url, poolclass=TimedQueuePool)
+        instrument_engine(self._engine.sync_engine, 'primary')
+        track_queries(self._engine.sync_engine)
         self._session_maker: async_sessionmaker = async_sessionmaker(autoflush=False, autocommit=False,
                                                                      expire_on_commit=False, bind=self._engine)
+        self._replicas = [Replica(replica_url, f'replica{index}')
+                          for index, replica_url in enumerate(replica_urls or [])]
+        self._next_replica = itertools.count()
+
+    # Round robin over the replicas, skipping unavailable or lagging ones
+    async def _pick_replica(self) -> Replica | None:
+        if not self._replicas:
+            return None
+        start = next(self._next_replica)
+        for index in range(len(self._replicas)):
+            replica = self._replicas[(start + index) % len(self._replicas)]
+            if await replica.is_available():
+                return replica
+        return None
 
     @contextlib.asynccontextmanager
-    async def session(self):
-        if self._session_maker is None:
+    async def _session(self, session_maker: async_sessionmaker):
+        if session_maker is None:
             raise Exception("Session is not initialized")
-        session = self._session_maker()
+        session = session_maker()
         try:
             yield session
         except Exception as err:
@@ -25,13 +83,61 @@ class DatabaseSessionManager:
         finally:
             await session.close()
 
+    def session(self):
+        return self._session(self._session_maker)
+
+    # Session on a replica, or on the primary when no replica can serve
+    @contextlib.asynccontextmanager
+    async def read_session(self):
+        replica = await self._pick_replica()
+        async with self._session(replica.session_maker if replica else self._session_maker) as session:
+            yield session
+
 
-async def get_db():
+def _client_key(request: Request) -> str:
+    client = request.headers.get('authorization') or (request.client.host if request.client else '')
+    return 'rw:' + hashlib.sha256(client.encode()).hexdigest()
+
+
+async def _remember_write(request: Request):
+    try:
+        await db_redis.set(_client_key(request), 1, ex=settings.read_your_writes_seconds)
+    except RedisError as err:
+        print(err)
+
+
+async def _wrote_recently(request: Request) -> bool:
+    try:
+        return await db_redis.exists(_client_key(request)) > 0
+    except RedisError as err:
+        print(err)
+        return False
+
+
+def _mark_committed(session):
+    session.info['committed'] = True
+
+
+async def get_db(request: Request):
     async with sessionmanager.session() as session:
+        event.listen(session.sync_session, 'after_commit', _mark_committed)
+        yield session
+        if session.info.get('committed'):
+            await _remember_write(request)
+
+
+# For read-only handlers: replicas, except right after the same client wrote (read-your-writes)
+async def get_read_db(request: Request):
+    if await _wrote_recently(request):
+        async with sessionmanager.session() as session:
+            yield session
+        return
+    async with sessionmanager.read_session() as session:
         yield session
 
 
-sessionmanager = DatabaseSessionManager(settings.db_local_url)
+sessionmanager = DatabaseSessionManager(settings.db_local_url,
+                                        [url.strip() for url in settings.db_replica_urls.split(',') if url.strip()])
 
-db_redis = redis_async.Redis(host=settings.redis_host, port=settings.redis_port, db=0, encoding="utf-8",
+db_redis = InstrumentedRedis(host=settings.redis_host, port=settings.redis_port, db=0, encoding="utf-8",
                              decode_responses=True)
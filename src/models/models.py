@@ -2,8 +2,10 @@ import enum
 import uuid
 from datetime import datetime
 
-from sqlalchemy import String, Integer, ForeignKey, DateTime, func, Column, Boolean, Table, Enum, CheckConstraint, UUID
-from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column
+from sqlalchemy import String, Integer, ForeignKey, DateTime, func, Column, Boolean, Table, Enum, CheckConstraint, UUID, \
+    Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column, deferred
 
 
 class Base(DeclarativeBase):
@@ -34,14 +36,54 @@ class User(Base):
 
 class ImageTagAssociation(Base):
     __tablename__ = "image_tag_association"
+    __table_args__ = (
+        UniqueConstraint('image_id', 'tag_id', name='uq_image_tag_association_image_id_tag_id'),
+        Index('ix_image_tag_association_tag_id_image_id', 'tag_id', 'image_id'),
+    )
     id = Column(Integer, primary_key=True)
     image_id = Column(Integer, ForeignKey("images.id", ondelete="CASCADE", onupdate="CASCADE"))
     tag_id = Column(Integer, ForeignKey("tags.id", ondelete="CASCADE", onupdate="CASCADE"))
 
 
 
+class ImageBlob(Base):
+    __tablename__ = 'image_blobs'
+
+    content_hash = Column(String(64), primary_key=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    mime_type = Column(String)
+    ref_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+
+class ImageVariant(Base):
+    __tablename__ = 'image_variants'
+    __table_args__ = (
+        UniqueConstraint('content_hash', 'preset', name='uq_image_variants_content_hash_preset'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), ForeignKey("image_blobs.content_hash", ondelete="CASCADE"), nullable=False,
+                          index=True)
+    preset = Column(String(20), nullable=False)
+    path = Column(String, nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    mime_type = Column(String, nullable=False)
+    presets_version = Column(String(20), nullable=False, index=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
 class Image(Base):
     __tablename__ = 'images'
+    __table_args__ = (
+        Index('ix_images_created_at_id', 'created_at', 'id'),
+        Index('ix_images_owner_id_created_at_id', 'owner_id', 'created_at', 'id'),
+        Index('ix_images_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False, index=True)
@@ -53,28 +95,42 @@ class Image(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     owner_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
     count_tags = Column(Integer, default=0, nullable=False)
+    comment_count = Column(Integer, default=0, server_default='0', nullable=False)
+    content_hash = Column(String(64), ForeignKey("image_blobs.content_hash"), nullable=True, index=True)
+    # Title text, maintained by a database trigger; comments keep their own, see Comment.search_vector
+    search_vector = deferred(Column(TSVECTOR))
     owner = relationship("User", back_populates="images", lazy="joined")
-    tags = relationship("Tag", secondary="image_tag_association", back_populates="images", lazy="joined")
-    comments = relationship("Comment", back_populates="image")
+    tags = relationship("Tag", secondary="image_tag_association", back_populates="images", lazy="selectin")
+    comments = relationship("Comment", back_populates="image", passive_deletes=True)
 
 
 class Tag(Base):
     __tablename__ = 'tags'
+    __table_args__ = (
+        Index('ix_tags_name_prefix', 'name', postgresql_ops={'name': 'text_pattern_ops'}),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
-    images = relationship("Image", secondary="image_tag_association", back_populates="tags", lazy="joined")
+    usage_count = Column(Integer, server_default='0', nullable=False)
+    images = relationship("Image", secondary="image_tag_association", back_populates="tags", lazy="raise")
 
 
 class Comment(Base):
     __tablename__ = 'comments'
+    __table_args__ = (
+        Index('ix_comments_image_id_created_at_id', 'image_id', 'created_at', 'id'),
+        Index('ix_comments_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    text = Column(String, index=True)
+    text = Column(String)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     user_id = Column(UUID(as_uuid=True), ForeignKey('users.id'))
-    image_id = Column(Integer, ForeignKey('images.id'))
+    image_id = Column(Integer, ForeignKey('images.id', ondelete="CASCADE"))
+    # Comment text, maintained by a database trigger
+    search_vector = deferred(Column(TSVECTOR))
 
     user = relationship("User", back_populates="comments")
     image = relationship("Image", back_populates="comments")
@@ -0,0 +1,64 @@
+from sqlalchemy import select, update, delete, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from src.models.models import Comment, Image, User
+from src.repository.images import encode_cursor, decode_cursor, invalidate_image_listings, get_image_tag_names
+
+
+async def get_comment(comment_id: int, db: AsyncSession) -> Comment | None:
+    query = (select(Comment).filter_by(id=comment_id)
+             .options(joinedload(Comment.user))
+             .execution_options(populate_existing=True))
+    result = await db.execute(query)
+    return result.scalar_one_or_none()
+
+
+# Oldest first, keyset paginated on (created_at, id) within the image
+async def get_image_comments(image_id: int, limit: int, db: AsyncSession, cursor: str | None = None):
+    query = select(Comment).filter_by(image_id=image_id).options(joinedload(Comment.user))
+    if cursor:
+        query = query.filter(tuple_(Comment.created_at, Comment.id) > decode_cursor(cursor))
+    query = query.order_by(Comment.created_at, Comment.id).limit(limit)
+    result = await db.execute(query)
+    comments = result.scalars().all()
+    next_cursor = encode_cursor(comments[-1]) if len(comments) == limit else None
+    return comments, next_cursor
+
+
+# images.comment_count changes in the same transaction as the comment itself
+async def _change_comment_count(image_id: int, delta: int, db: AsyncSession):
+    query = (update(Image).filter_by(id=image_id)
+             .values(comment_count=Image.comment_count + delta)
+             .execution_options(synchronize_session=False))
+    await db.execute(query)
+
+
+async def create_comment(image_id: int, text: str, user: User, db: AsyncSession) -> Comment | None:
+    result = await db.execute(select(Image.id).filter_by(id=image_id))
+    if result.scalar_one_or_none() is None:
+        return None
+    comment = Comment(text=text, image_id=image_id, user_id=user.id)
+    db.add(comment)
+    await _change_comment_count(image_id, 1, db)
+    await db.commit()
+    await invalidate_image_listings(await get_image_tag_names([image_id], db))
+    return await get_comment(comment.id, db)
+
+
+async def update_comment(comment: Comment, text: str, db: AsyncSession) -> Comment:
+    comment.text = text
+    await db.commit()
+    return await get_comment(comment.id, db)
+
+
+# The count drops only if this request removed the row, so concurrent deletes of one comment count once
+async def delete_comment(comment: Comment, db: AsyncSession):
+    result = await db.execute(delete(Comment).filter_by(id=comment.id).returning(Comment.image_id)
+                              .execution_options(synchronize_session=False))
+    image_id = result.scalar_one_or_none()
+    if image_id is None:
+        return
+    await _change_comment_count(image_id, -1, db)
+    await db.commit()
+    await invalidate_image_listings(await get_image_tag_names([image_id], db))
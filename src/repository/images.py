@@ -1,19 +1,41 @@
+import asyncio
+import base64
+import binascii
+import hashlib
 import os
+import tempfile
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple
 from uuid import uuid4
 
-import cloudinary
-import cloudinary.uploader
 from fastapi import UploadFile, HTTPException
 from pydantic import ValidationError
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, tuple_, func, values, column, cast, Integer, and_, or_, \
+    true, union_all
+from sqlalchemy.dialects.postgresql import insert, REGCONFIG
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload, noload, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 
-from src.models.models import Image, Tag, User
+from src.models.models import Image, ImageBlob, ImageVariant, ImageTagAssociation, Tag, User, Comment
 from src.conf.config import settings
 from src.schemas.images import ImageCreateSchema
+from src.services import metrics
+from src.services.storage import storage, discard_file
+from src.services.response_cache import response_cache, images_tag, tag_name_tag
+
+
+# Text search configuration used by the images and comments search_vector triggers
+SEARCH_CONFIG = 'simple'
+
+# Loader options per query path: owner is many-to-one and is joined, tags come with one extra IN query
+IMAGE_LIST_OPTIONS = (joinedload(Image.owner), selectinload(Image.tags))
+# Serving a file needs the image columns only
+IMAGE_FILE_OPTIONS = (noload(Image.owner), noload(Image.tags))
 
 
 async def get_image(query, db: AsyncSession):
@@ -22,36 +44,242 @@ async def get_image(query, db: AsyncSession):
 
 
 async def get_images(query, db: AsyncSession):
-    images = await db.execute(query)
+    images = await db.execute(query.options(*IMAGE_LIST_OPTIONS))
     return images.unique().scalars().all()
 
 
-# Delete file from uploads folder
-async def delete_image_from_uploads(file_name):
+# Plain rows for listings that are serialized without models, see src/services/serialization.py
+IMAGE_ROW_COLUMNS = (Image.id, Image.title, Image.image_path, Image.mime_type, Image.created_at, Image.updated_at,
+                     Image.count_tags, Image.comment_count, Image.owner_id, User.email.label('owner_email'),
+                     User.username.label('owner_username'), User.avatar.label('owner_avatar'),
+                     User.role.label('owner_role'))
+
+
+# Same filters, order and limit as a select(Image) query, projected to IMAGE_ROW_COLUMNS
+async def get_image_rows(query, db: AsyncSession):
+    query = query.with_only_columns(*IMAGE_ROW_COLUMNS).join_from(Image, User, Image.owner_id == User.id)
+    result = await db.execute(query)
+    return result.all()
+
+
+# Opaque cursor of the last image on a page: (created_at, id)
+def encode_cursor(image: Image) -> str:
+    raw = f'{image.created_at.isoformat()}|{image.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
     try:
-        os.remove(settings.uploaded_files_path + file_name)
-    except Exception as e:
-        print(e)
+        created_at, image_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(image_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
 
-# Save file to uploads folder
-async def save_file_to_uploads(file, filename):
-    if not os.path.exists(settings.uploaded_files_path):
-        os.makedirs(settings.uploaded_files_path)
-    image_path = f'{settings.uploaded_files_path}{filename}'
-    with open(image_path, "wb") as uploaded_file:
-        file_content = await file.read()
-        uploaded_file.write(file_content)
-        uploaded_file.close()
-    return image_path
+# Cursor of the last search hit: (rank, id)
+def encode_search_cursor(rank: float, image_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{rank!r}|{image_id}'.encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    try:
+        rank, image_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(rank), int(image_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
 
+# Newest first; keyset pagination when cursor is given, offset otherwise
+def paginate(query, limit: int, offset: int, cursor: str | None = None):
+    query = query.order_by(Image.created_at.desc(), Image.id.desc())
+    if cursor:
+        query = query.filter(tuple_(Image.created_at, Image.id) < decode_cursor(cursor))
+    else:
+        query = query.offset(offset)
+    return query.limit(limit)
+
+
+def next_cursor(images, limit: int) -> str | None:
+    if len(images) < limit:
+        return None
+    return encode_cursor(images[-1])
+
+
+# Serializes deleting a blob's files with uploads of the same content until the transaction ends
+def blob_lock(content_hash: str):
+    return select(func.pg_advisory_xact_lock(func.hashtext(content_hash)))
+
+
+# Delete files released by delete_image_from_db, unless an upload of the same content has stored them again
+async def delete_image_from_uploads(image: Image, file_paths: list[str], db: AsyncSession):
+    if not file_paths:
+        return
+    if image.content_hash is not None:
+        await db.execute(blob_lock(image.content_hash))
+        stored_again = await db.scalar(select(ImageBlob.content_hash).filter_by(content_hash=image.content_hash))
+        if stored_again is not None:
+            await db.commit()
+            return
+    # The lock is held while deleting so a concurrent upload writes its file only afterwards
+    for file_path in file_paths:
+        try:
+            await storage.delete(file_path)
+        except Exception as e:
+            print(e)
+    await db.commit()
+
+
+async def get_variant(content_hash: str, preset: str, db: AsyncSession) -> ImageVariant | None:
+    query = select(ImageVariant).filter_by(content_hash=content_hash, preset=preset)
+    result = await db.execute(query)
+    return result.scalar_one_or_none()
+
+
+async def save_variants(content_hash: str, variants: list[dict], presets_version: str, db: AsyncSession):
+    values = [dict(variant, content_hash=content_hash, presets_version=presets_version) for variant in variants]
+    query = insert(ImageVariant).values(values)
+    query = query.on_conflict_do_update(constraint='uq_image_variants_content_hash_preset',
+                                        set_={'path': query.excluded.path, 'width': query.excluded.width,
+                                              'height': query.excluded.height, 'size': query.excluded.size,
+                                              'mime_type': query.excluded.mime_type,
+                                              'presets_version': query.excluded.presets_version,
+                                              'updated_at': func.now()})
+    await db.execute(query)
+    await db.commit()
+
+
+# Blobs that miss a variant of the current presets version
+async def get_blobs_with_outdated_variants(presets_version: str, preset_count: int, limit: int, db: AsyncSession,
+                                           after: str | None = None):
+    current = (select(func.count(ImageVariant.id))
+               .filter(ImageVariant.content_hash == ImageBlob.content_hash)
+               .filter(ImageVariant.presets_version == presets_version)
+               .scalar_subquery())
+    query = select(ImageBlob).filter(current < preset_count)
+    if after:
+        query = query.filter(ImageBlob.content_hash > after)
+    query = query.order_by(ImageBlob.content_hash).limit(limit)
+    result = await db.execute(query)
+    return result.scalars().all()
 
-# Get file size
-async def get_file_size(file):
-    file_content = await file.read()
-    file_size = len(file_content)
-    await file.seek(0)
-    return file_size
+
+class StoredFile(NamedTuple):
+    path: str
+    size: int
+    content_hash: str
+    mime_type: str
+
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+)
+
+
+# Detect image type by magic bytes of the first chunk
+def sniff_image_type(head: bytes) -> str | None:
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return None
+
+
+# Copy the spooled upload to a temp file in uploads folder chunk by chunk, checking size and type on the fly;
+# the request body itself is capped by BodySizeLimitMiddleware
+async def stream_file_to_uploads(file: UploadFile) -> StoredFile:
+    if not os.path.exists(settings.uploaded_files_path):
+        os.makedirs(settings.uploaded_files_path)
+    fd, tmp_path = await run_in_threadpool(tempfile.mkstemp, suffix='.part', dir=settings.uploaded_files_path)
+    tmp_file = os.fdopen(fd, 'wb')
+    digest = hashlib.sha256()
+    size = 0
+    mime_type = None
+    try:
+        while chunk := await file.read(settings.upload_chunk_size):
+            if mime_type is None:
+                mime_type = sniff_image_type(chunk)
+                if mime_type is None:
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                        detail="File is not an image. Only images are allowed")
+            size += len(chunk)
+            if size > settings.max_image_size:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"File too large. Max size is {settings.max_image_size} bytes")
+            digest.update(chunk)
+            await run_in_threadpool(tmp_file.write, chunk)
+        await run_in_threadpool(tmp_file.close)
+        if mime_type is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File is empty")
+    except BaseException:
+        tmp_file.close()
+        discard_file(tmp_path)
+        metrics.UPLOAD_FILES.labels('rejected').inc()
+        metrics.UPLOAD_BYTES.labels('rejected').inc(size)
+        raise
+    metrics.UPLOAD_FILES.labels('stored').inc()
+    metrics.UPLOAD_BYTES.labels('stored').inc(size)
+    return StoredFile(path=tmp_path, size=size, content_hash=digest.hexdigest(), mime_type=mime_type)
+
+
+async def discard_stored_files(stored_files: list[StoredFile]):
+    for stored_file in stored_files:
+        await run_in_threadpool(discard_file, stored_file.path)
+
+
+# Register a reference to the blob with the file content; the file is put in storage only for a new blob
+async def save_blob(stored_file: StoredFile, filename: str, db: AsyncSession) -> ImageBlob:
+    blobs, _ = await save_blobs([(stored_file, filename)], db)
+    return blobs[stored_file.content_hash]
+
+
+# Same for many files in one upsert; returns blobs by hash and the hashes whose file was written
+async def save_blobs(entries: list[tuple[StoredFile, str]], db: AsyncSession) -> tuple[dict, set]:
+    counts = Counter(stored_file.content_hash for stored_file, _ in entries)
+    values = {}
+    for stored_file, filename in entries:
+        values.setdefault(stored_file.content_hash, {
+            'content_hash': stored_file.content_hash, 'path': f'{settings.uploaded_files_path}{filename}',
+            'size': stored_file.size, 'mime_type': stored_file.mime_type,
+            'ref_count': counts[stored_file.content_hash]})
+    # Same lock order in every transaction; see delete_image_from_uploads
+    for content_hash in sorted(values):
+        await db.execute(blob_lock(content_hash))
+    query = insert(ImageBlob).values([values[content_hash] for content_hash in sorted(values)])
+    query = (query.on_conflict_do_update(index_elements=[ImageBlob.content_hash],
+                                         set_={'ref_count': ImageBlob.ref_count + query.excluded.ref_count})
+             .returning(ImageBlob)
+             .execution_options(populate_existing=True))
+    result = await db.execute(query)
+    blobs = {blob.content_hash: blob for blob in result.scalars().all()}
+    # One put per new blob, run concurrently so the advisory locks are held for the slowest upload only
+    semaphore = asyncio.Semaphore(settings.storage_max_concurrency)
+
+    async def put(blob: ImageBlob, stored_file: StoredFile) -> str | None:
+        async with semaphore:
+            if blob.ref_count == counts[blob.content_hash] or not await storage.exists(blob.path):
+                await storage.put(blob.path, stored_file.path, blob.mime_type)
+                return blob.content_hash
+
+    sources = {}
+    for stored_file, _ in entries:
+        sources.setdefault(stored_file.content_hash, stored_file)
+    try:
+        results = await asyncio.gather(*[put(blobs[content_hash], stored_file)
+                                         for content_hash, stored_file in sources.items()], return_exceptions=True)
+    finally:
+        for stored_file, _ in entries:
+            await run_in_threadpool(discard_file, stored_file.path)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return blobs, {result for result in results if result}
 
 
 async def file_is_image(file: UploadFile):
@@ -61,90 +289,313 @@ async def file_is_image(file: UploadFile):
         return False
 
 
+# Drop cached listings an image appears in: all images and each of its tags
+async def invalidate_image_listings(tag_names):
+    await response_cache.invalidate(images_tag(), *[tag_name_tag(name) for name in tag_names])
+
+
+async def get_image_tag_names(image_ids, db: AsyncSession) -> list[str]:
+    query = (select(Tag.name).distinct()
+             .join(ImageTagAssociation, ImageTagAssociation.tag_id == Tag.id)
+             .filter(ImageTagAssociation.image_id.in_(image_ids)))
+    result = await db.execute(query)
+    return result.scalars().all()
+
+
 # Update File in DB
 async def update_image_title(image: Image, title: str, db: AsyncSession):
+    tag_names = [tag.name for tag in image.tags]
     image.title = title
     await db.commit()
     await db.refresh(image)
+    await invalidate_image_listings(tag_names)
     return image
 
 
 #
 #
 # Delete image from DB
-async def delete_image_from_db(image: Image, db: AsyncSession):
+# Delete the image and release its blob in one transaction; returns the files no image references anymore
+async def delete_image_from_db(image: Image, db: AsyncSession) -> list[str]:
+    tag_names = [tag.name for tag in image.tags]
     await db.delete(image)
+    # The image row goes first: images.content_hash references the blob
+    await db.flush()
+    file_paths = [settings.uploaded_files_path + image.name]
+    if image.content_hash is not None:
+        file_paths = []
+        result = await db.execute(update(ImageBlob).filter_by(content_hash=image.content_hash)
+                                  .values(ref_count=ImageBlob.ref_count - 1)
+                                  .returning(ImageBlob.ref_count))
+        ref_count = result.scalar_one_or_none()
+        if ref_count is not None and ref_count <= 0:
+            variants = await db.execute(delete(ImageVariant).filter_by(content_hash=image.content_hash)
+                                        .returning(ImageVariant.path))
+            variant_paths = variants.scalars().all()
+            blob = await db.execute(delete(ImageBlob).filter_by(content_hash=image.content_hash)
+                                    .filter(ImageBlob.ref_count <= 0)
+                                    .returning(ImageBlob.path))
+            blob_path = blob.scalar_one_or_none()
+            if blob_path is not None:
+                file_paths = [blob_path, *variant_paths]
     await db.commit()
+    await invalidate_image_listings(tag_names)
+    return file_paths
+
+
+TAG_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+# "beach AND sunset NOT night OR sea" -> [(['beach', 'sunset'], ['night']), (['sea'], [])]
+# OR separates groups, AND is implied between terms, NOT excludes the next tag
+def parse_tag_expression(expression: str) -> list[tuple[list[str], list[str]]]:
+    def invalid(detail: str):
+        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid tag expression: {detail}")
+
+    groups = []
+    required, excluded = [], []
+    negate = False
+    tokens = expression.split()
+    if len([token for token in tokens if token not in TAG_OPERATORS]) > settings.max_expression_tags:
+        raise invalid(f"no more than {settings.max_expression_tags} tags are allowed")
+    for token in tokens:
+        if token in TAG_OPERATORS and negate:
+            raise invalid("NOT must be followed by a tag")
+        if token == 'OR':
+            if not required and not excluded:
+                raise invalid("OR must be between tags")
+            groups.append((required, excluded))
+            required, excluded = [], []
+        elif token == 'NOT':
+            negate = True
+        elif token != 'AND':
+            if not 3 <= len(token) <= 50:
+                raise invalid(f"tag '{token}' must be 3 to 50 characters")
+            (excluded if negate else required).append(token)
+            negate = False
+    if negate or (not required and not excluded):
+        raise invalid("expression must end with a tag")
+    groups.append((required, excluded))
+    return groups
+
+
+# Correlated semi-join: the image has a tag with this name
+def has_tag(name: str):
+    association = aliased(ImageTagAssociation)
+    tag = aliased(Tag)
+    return (select(association.id)
+            .join(tag, tag.id == association.tag_id)
+            .filter(association.image_id == Image.id)
+            .filter(tag.name == name)
+            .exists())
+
+
+# Filter on images matching any group: an EXISTS per required tag and NOT EXISTS per excluded one.
+# Being correlated on images.id, it lets the planner walk ix_images_created_at_id and stop at LIMIT
+# instead of aggregating every association of the tags first
+def images_matching_tags(groups: list[tuple[list[str], list[str]]]):
+    conditions = [and_(*[has_tag(name) for name in dict.fromkeys(required)],
+                       *[~has_tag(name) for name in dict.fromkeys(excluded)])
+                  for required, excluded in groups]
+    return conditions[0] if len(conditions) == 1 else or_(*conditions)
+
+
+async def get_images_by_tag(groups: list[tuple[list[str], list[str]]], limit: int, offset: int,
+                            db: AsyncSession, cursor: str | None = None):
+    query = paginate(select(Image).filter(images_matching_tags(groups)), limit, offset, cursor)
+    return await get_image_rows(query, db)
+
+
+# Full-text search over titles and comments, best matches first, keyset paginated on (rank, id).
+# The title and each comment are matched on their own, and an image ranks by its best matching one.
+async def search_images(text: str, limit: int, db: AsyncSession, cursor: str | None = None):
+    tsquery = func.websearch_to_tsquery(cast(SEARCH_CONFIG, REGCONFIG), text)
+    matches = union_all(
+        select(Image.id.label('image_id'), func.ts_rank_cd(Image.search_vector, tsquery).label('rank'))
+        .filter(Image.search_vector.op('@@')(tsquery)),
+        select(Comment.image_id, func.ts_rank_cd(Comment.search_vector, tsquery))
+        .filter(Comment.search_vector.op('@@')(tsquery))
+    ).subquery()
+    ranks = (select(matches.c.image_id, func.max(matches.c.rank).label('rank'))
+             .group_by(matches.c.image_id)
+             .subquery())
+    rank = ranks.c.rank
+    query = select(Image, rank).join(ranks, ranks.c.image_id == Image.id)
+    if cursor:
+        query = query.filter(tuple_(rank, Image.id) < decode_search_cursor(cursor))
+    query = query.order_by(rank.desc(), Image.id.desc()).limit(limit).options(*IMAGE_LIST_OPTIONS)
+    result = await db.execute(query)
+    rows = result.unique().all()
+    images = [image for image, _ in rows]
+    if len(rows) < limit:
+        return images, None
+    last_image, last_rank = rows[-1]
+    return images, encode_search_cursor(last_rank, last_image.id)
 
 
-async def get_images_by_tag(tag_name: str, limit: int, offset: int, db: AsyncSession):
-    query = select(Tag).filter_by(name=tag_name)
-    tag = await db.execute(query)
-    tag = tag.unique().scalar_one_or_none()
-    if tag:
-        query = select(Image).filter(Image.tags.contains(tag)).offset(offset).limit(limit)
-        images = await db.execute(query)
-        return images.unique().scalars().all()
-    return
+async def get_all_images(limit: int, offset: int, db: AsyncSession, cursor: str | None = None):
+    query = paginate(select(Image), limit, offset, cursor)
+    return await get_image_rows(query, db)
 
 
-async def get_all_images(limit: int, offset: int, db: AsyncSession):
-    query = select(Image).offset(offset).limit(limit)
-    images = await db.execute(query)
-    return images.scalars().all()
+# Attach a tag in one statement: upsert the tag, lock the image, insert the association while the image has room
+# for a tag unless it exists, and bump count_tags only when a row was inserted
+async def add_tag_to_image(image_id: int, tag_name: str, db: AsyncSession):
+    tag_insert = insert(Tag).values(name=tag_name)
+    tag = (tag_insert.on_conflict_do_update(index_elements=[Tag.name], set_={'name': tag_insert.excluded.name})
+           .returning(Tag.id)
+           .cte('tag'))
+    # FOR UPDATE returns the latest count_tags once the lock is granted, not the statement snapshot
+    locked = (select(Image.id, Image.count_tags)
+              .filter(Image.id == image_id)
+              .with_for_update()
+              .cte('locked'))
+    inserted = (insert(ImageTagAssociation)
+                .from_select(['image_id', 'tag_id'], select(locked.c.id, tag.c.id)
+                             .join_from(locked, tag, true())
+                             .filter(locked.c.count_tags < settings.max_add_tags))
+                .on_conflict_do_nothing(index_elements=['image_id', 'tag_id'])
+                .returning(ImageTagAssociation.image_id)
+                .cte('inserted'))
+    updated = (update(Image)
+               .where(Image.id == inserted.c.image_id)
+               .values(count_tags=Image.count_tags + 1)
+               .returning(Image.id, Image.count_tags)
+               .cte('updated'))
+    query = (select(Image, updated.c.count_tags, locked.c.count_tags.label('locked_count_tags'),
+                    select(tag.c.id).scalar_subquery().label('tag_id'))
+             .join(locked, locked.c.id == Image.id)
+             .outerjoin(updated, updated.c.id == Image.id)
+             .options(joinedload(Image.owner), noload(Image.tags)))
+    result = await db.execute(query)
+    row = result.one_or_none()
+    had_tag = False
+    if row is not None and row.count_tags is None:
+        # With room for a tag the insert only skips an existing association; a full image may have it too.
+        # This statement takes a new snapshot, so it sees an association committed while we waited for the lock.
+        had_tag = row.locked_count_tags < settings.max_add_tags or await db.scalar(
+            select(ImageTagAssociation.id).filter_by(image_id=image_id, tag_id=row.tag_id).exists().select())
+    await db.commit()
+    if row is None:
+        return
+    image, count_tags = row.Image, row.count_tags
+    if count_tags is None:
+        if had_tag:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tag is already added to image")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"You can't add more than {settings.max_add_tags} tags to image")
+    # The outer select reads the statement snapshot, take the counter from UPDATE ... RETURNING
+    set_committed_value(image, 'count_tags', count_tags)
+    await invalidate_image_listings(await get_image_tag_names([image_id], db))
+    return image
 
 
-async def add_tag_to_image(image_id: int, tag_name: str, db: AsyncSession):
-    query = select(Image).filter_by(id=image_id)
-    image = await db.execute(query)
-    image = image.unique().scalar_one_or_none()
-    tag = await create_tag(tag_name, db)
-    if image:
-        if tag not in image.tags and image.count_tags <= settings.max_add_tags-1:
-            image.count_tags += 1
-            image.tags.append(tag)
-            await db.commit()
-            await db.refresh(image)
-            return image
-        else:
-            if tag in image.tags:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tag is already added to image")
-            else:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail=f"You can't add more than {settings.max_add_tags} tags to image")
-
-    return
-
-
-async def create_tag(tag_name: str, db: AsyncSession):
-    query = select(Tag).filter_by(name=tag_name)
-    tag = await db.execute(query)
-    tag = tag.unique().scalar_one_or_none()
-    if tag is None:
-        new_tag = Tag(name=tag_name)
-        db.add(new_tag)
-        await db.commit()
-        await db.refresh(new_tag)
-        return new_tag
-    return tag
+# Upsert tags by name in one statement, returns {name: id} for all of them
+# Also locks the tag rows, in name order: concurrent requests with overlapping tags, and the usage_count
+# trigger that updates them later in the transaction, then can't deadlock on each other
+async def upsert_tags(tag_names, db: AsyncSession) -> dict[str, int]:
+    query = insert(Tag).values([{'name': name} for name in sorted(tag_names)])
+    query = (query.on_conflict_do_update(index_elements=[Tag.name], set_={'name': query.excluded.name})
+             .returning(Tag.name, Tag.id))
+    result = await db.execute(query)
+    return dict(result.all())
+
+
+# Attach many tags to many of the user's images and commit once; max_add_tags is enforced by the INSERT itself.
+# Returns the tag names actually added per image.
+async def add_tags_to_images(image_tags: dict[int, list[str]], user: User, db: AsyncSession) -> dict[int, list[str]]:
+    result = await db.execute(select(Image.id).filter(Image.id.in_(image_tags)).filter_by(owner_id=user.id))
+    missing = set(image_tags) - set(result.scalars().all())
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Images not found: {', '.join(map(str, sorted(missing)))}")
+    tag_ids = await upsert_tags({name for names in image_tags.values() for name in names}, db)
+    tag_names = {tag_id: name for name, tag_id in tag_ids.items()}
+
+    # Lock the images in a stable order so count_tags can't change under us
+    await db.execute(select(Image.id).filter(Image.id.in_(image_tags)).order_by(Image.id).with_for_update())
+
+    requested = values(column('image_id', Integer), column('tag_id', Integer), column('position', Integer),
+                       name='requested').data([(image_id, tag_ids[name], position)
+                                               for image_id, names in image_tags.items()
+                                               for position, name in enumerate(names)])
+    already_added = (select(ImageTagAssociation.id)
+                     .filter(ImageTagAssociation.image_id == requested.c.image_id)
+                     .filter(ImageTagAssociation.tag_id == requested.c.tag_id)
+                     .exists())
+    candidates = (select(requested.c.image_id, requested.c.tag_id,
+                         (Image.count_tags + func.row_number().over(partition_by=requested.c.image_id,
+                                                                    order_by=requested.c.position))
+                         .label('new_count'))
+                  .join(Image, Image.id == requested.c.image_id)
+                  .filter(~already_added)
+                  .cte('candidates'))
+    inserted = (insert(ImageTagAssociation)
+                .from_select(['image_id', 'tag_id'],
+                             select(candidates.c.image_id, candidates.c.tag_id)
+                             .filter(candidates.c.new_count <= settings.max_add_tags))
+                .returning(ImageTagAssociation.image_id, ImageTagAssociation.tag_id)
+                .cte('inserted'))
+    added = (select(inserted.c.image_id, func.count().label('added'))
+             .group_by(inserted.c.image_id)
+             .subquery('added'))
+    updated = (update(Image)
+               .where(Image.id == added.c.image_id)
+               .values(count_tags=Image.count_tags + added.c.added)
+               .returning(Image.id)
+               .cte('updated'))
+    result = await db.execute(select(inserted.c.image_id, inserted.c.tag_id).add_cte(updated))
+    added_tags = {image_id: [] for image_id in image_tags}
+    for image_id, tag_id in result.all():
+        added_tags[image_id].append(tag_names[tag_id])
+    await db.commit()
+    changed = [image_id for image_id, names in added_tags.items() if names]
+    if changed:
+        await invalidate_image_listings(await get_image_tag_names(changed, db))
+    return added_tags
 
 
+# Insert the image, its tag and the association in one transaction, like create_upload_images
 async def create_upload_image(tag: str | None, user: User, db: AsyncSession, **kwargs):
     data = ImageCreateSchema(name=kwargs['name'], size=kwargs['size'], mime_type=kwargs['mime_type'],
-                             title=kwargs['title'], image_path=kwargs['file_path'])
-    new_image = Image(**data.model_dump(exclude_unset=True), owner_id=user.id)
+                             title=kwargs['title'], image_path=kwargs['file_path'],
+                             content_hash=kwargs.get('content_hash'))
+    new_image = Image(**data.model_dump(exclude_unset=True), owner_id=user.id, count_tags=1 if tag else 0)
+    db.add(new_image)
+    await db.flush()
+    image_id = new_image.id
 
     if tag:
-        tag = await create_tag(tag, db)
-        new_image.count_tags = 1
-        new_image.tags.append(tag)
-    db.add(new_image)
+        tag_ids = await upsert_tags({tag}, db)
+        await db.execute(insert(ImageTagAssociation).values(image_id=image_id, tag_id=tag_ids[tag]))
+    await db.commit()
+    await invalidate_image_listings([tag] if tag else [])
+    images = await get_images(select(Image).filter_by(id=image_id), db)
+    return images[0]
+
+
+# Insert many uploaded images with their tags in bulk statements and a single commit
+async def create_upload_images(items: list[dict], user: User, db: AsyncSession) -> list[Image]:
+    rows = [ImageCreateSchema(name=item['name'], size=item['size'], mime_type=item['mime_type'], title=item['title'],
+                              image_path=item['file_path'], content_hash=item['content_hash']).model_dump()
+            | {'owner_id': user.id, 'count_tags': 1 if item['tag'] else 0} for item in items]
+    result = await db.execute(insert(Image).returning(Image.id, sort_by_parameter_order=True), rows)
+    image_ids = result.scalars().all()
+
+    tag_names = {item['tag'] for item in items if item['tag']}
+    if tag_names:
+        tag_ids = await upsert_tags(tag_names, db)
+        await db.execute(insert(ImageTagAssociation), [{'image_id': image_id, 'tag_id': tag_ids[item['tag']]}
+                                                       for image_id, item in zip(image_ids, items) if item['tag']])
     await db.commit()
-    await db.refresh(new_image)
-    return new_image
+    await invalidate_image_listings(tag_names)
+
+    images = await get_images(select(Image).filter(Image.id.in_(image_ids)), db)
+    images_by_id = {image.id: image for image in images}
+    return [images_by_id[image_id] for image_id in image_ids]
 
 
-async def format_filename(file):
+async def format_filename(file, content_hash: str | None = None):
     filename, ext = os.path.splitext(file.filename)
-    new_filename = f"{uuid4().hex}{ext}"
+    new_filename = f"{content_hash or uuid4().hex}{ext}"
     return new_filename
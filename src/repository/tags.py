@@ -0,0 +1,15 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.models.models import Tag
+
+
+# Most used tags starting with prefix; served by the text_pattern_ops index on tags.name
+async def suggest_tags(prefix: str, limit: int, db: AsyncSession):
+    query = (select(Tag.name, Tag.usage_count)
+             .filter(Tag.name.startswith(prefix, autoescape=True))
+             .filter(Tag.usage_count > 0)
+             .order_by(Tag.usage_count.desc(), Tag.name)
+             .limit(limit))
+    result = await db.execute(query)
+    return result.mappings().all()
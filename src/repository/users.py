@@ -1,11 +1,33 @@
+import json
+import uuid
+from datetime import datetime
+
 from fastapi import Depends
+from redis.exceptions import RedisError
 from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 from libgravatar import Gravatar
 
-from src.database.db import get_db
+from src.conf.config import settings
+from src.database.db import get_db, db_redis
 from src.models.models import User, Role
 from src.schemas.user import UserCreateSchema
+from src.services.response_cache import response_cache, owner_tag
+
+# Columns kept in the Redis snapshot of an authenticated user (no password hash or tokens)
+CACHED_USER_FIELDS = ('id', 'username', 'email', 'role', 'avatar', 'confirmed', 'registered_at', 'updated_at')
+USER_GENERATION_TTL = 24 * 60 * 60
+
+# Store the snapshot only if no invalidation happened since the generation was read before the DB query
+CACHE_USER_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', tonumber(ARGV[3]))
+return 1
+"""
+_cache_user_script = db_redis.register_script(CACHE_USER_SCRIPT)
 
 
 async def get_user_by_email(email: str, db: AsyncSession = Depends(get_db)) -> User | None:
@@ -14,6 +36,71 @@ async def get_user_by_email(email: str, db: AsyncSession = Depends(get_db)) -> U
     return user.scalar_one_or_none()
 
 
+def user_cache_key(email: str) -> str:
+    return f"user:{email}"
+
+
+def user_generation_key(email: str) -> str:
+    return f"user:{email}:generation"
+
+
+# Read before loading the user from the database and pass to cache_user; None when Redis is unavailable
+async def get_user_generation(email: str) -> str | None:
+    try:
+        generation = await db_redis.get(user_generation_key(email))
+    except RedisError as err:
+        print(err)
+        return None
+    return generation or ''
+
+
+async def get_cached_user(email: str) -> User | None:
+    try:
+        snapshot = await db_redis.get(user_cache_key(email))
+    except RedisError as err:
+        print(err)
+        return None
+    if snapshot is None:
+        return None
+    data = json.loads(snapshot)
+    data['id'] = uuid.UUID(data['id'])
+    data['role'] = Role(data['role'])
+    for field in ('registered_at', 'updated_at'):
+        if data[field] is not None:
+            data[field] = datetime.fromisoformat(data[field])
+    user = User(**data)
+    make_transient_to_detached(user)
+    return user
+
+
+async def cache_user(user: User, generation: str | None):
+    if generation is None:
+        return
+    data = {field: getattr(user, field) for field in CACHED_USER_FIELDS}
+    data['id'] = str(user.id)
+    data['role'] = user.role.value
+    for field in ('registered_at', 'updated_at'):
+        if data[field] is not None:
+            data[field] = data[field].isoformat()
+    try:
+        await _cache_user_script(keys=[user_generation_key(user.email), user_cache_key(user.email)],
+                                 args=[generation, json.dumps(data), settings.user_cache_ttl])
+    except RedisError as err:
+        print(err)
+
+
+# Bumping the generation stops requests that loaded the user before the change from caching it again
+async def invalidate_cached_user(email: str):
+    try:
+        async with db_redis.pipeline(transaction=True) as pipe:
+            pipe.incr(user_generation_key(email))
+            pipe.expire(user_generation_key(email), USER_GENERATION_TTL)
+            pipe.delete(user_cache_key(email))
+            await pipe.execute()
+    except RedisError as err:
+        print(err)
+
+
 async def create_user(body: UserCreateSchema, db: AsyncSession = Depends(get_db)) -> User:
     avatar = None
     try:
@@ -37,14 +124,19 @@ async def create_user(body: UserCreateSchema, db: AsyncSession = Depends(get_db)
 
 
 async def update_token(user: User, token: str | None, db: AsyncSession):
+    # user may come detached from the Redis cache
+    if user not in db:
+        user = await db.get(User, user.id)
     user.refresh_token = token
     await db.commit()
+    await invalidate_cached_user(user.email)
 
 
 async def confirmed_email(email: str, db: AsyncSession):
     user = await get_user_by_email(email, db)
     user.confirmed = True
     await db.commit()
+    await invalidate_cached_user(email)
 
 
 async def update_avatar(email, url: str, db: AsyncSession) -> User:
@@ -52,11 +144,16 @@ async def update_avatar(email, url: str, db: AsyncSession) -> User:
     user.avatar = url
     await db.commit()
     await db.refresh(user)
+    await invalidate_cached_user(email)
+    await response_cache.invalidate(owner_tag(user.id))
     return user
 
 
 async def update_password(user: User, new_password: str, db: AsyncSession) -> User:
+    if user not in db:
+        user = await db.get(User, user.id)
     user.password = new_password
     await db.commit()
     await db.refresh(user)
+    await invalidate_cached_user(user.email)
     return user
@@ -1,6 +1,6 @@
 import secrets
 
-from fastapi import APIRouter, HTTPException, Depends, status, Security, BackgroundTasks, Request
+from fastapi import APIRouter, HTTPException, Depends, status, Security, Request
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -10,6 +10,7 @@ from src.schemas.user import UserCreateSchema, TokenSchema, LogoutResponse, Requ
 from src.models.models import User
 from src.services.auth import auth_service
 from src.services.email import send_email
+from src.services.rate_limit import login_limiter, signup_limiter
 from src.conf import messages
 
 router = APIRouter(prefix='/auth', tags=['auth'])
@@ -18,26 +19,28 @@ get_refresh_token = HTTPBearer()
 
 
 @router.post("/signup", response_model=UserResponseSchema, status_code=status.HTTP_201_CREATED)
-async def signup(background_tasks: BackgroundTasks, request: Request, body: UserCreateSchema = Depends(),
+async def signup(request: Request, body: UserCreateSchema = Depends(),
                  db: AsyncSession = Depends(get_db)) -> dict:
+    await signup_limiter.check(request, body.email)
     exist_user = await repository_users.get_user_by_email(body.email, db)
 
     if exist_user:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=messages.ACCOUNT_EXISTS)
-    body.password = auth_service.get_password_hash(body.password)
+    body.password = await auth_service.get_password_hash(body.password)
     new_user = await repository_users.create_user(body, db)
-    background_tasks.add_task(send_email, new_user.email, new_user.username, str(request.base_url))
+    await send_email(new_user.email, new_user.username, str(request.base_url))
     return {"user": new_user, "detail": "User successfully created. Check your email for confirmation."}
 
 
 @router.post("/login", response_model=TokenSchema)
-async def login(body: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+async def login(request: Request, body: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    await login_limiter.check(request, body.username)
     user = await repository_users.get_user_by_email(body.username, db)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=messages.INVALID_EMAIL)
     if not user.confirmed:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=messages.NOT_CONFIRMED_EMAIL)
-    if not auth_service.verify_password(body.password, user.password):
+    if not await auth_service.verify_password(body.password, user.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=messages.INVALID_PASSWORD)
     # Generate JWT
     access_token = await auth_service.create_access_token(data={"sub": user.email})
@@ -49,8 +52,8 @@ async def login(body: OAuth2PasswordRequestForm = Depends(), db: AsyncSession =
 @router.post("/logout", response_model=LogoutResponse)
 async def logout(user: User = Depends(auth_service.get_current_user),
                  db: AsyncSession = Depends(get_db)) -> dict:
-    user.refresh_token = None
-    await db.commit()
+    await repository_users.update_token(user, None, db)
+    auth_service.token_cache.evict_subject(user.email)
     return {"result": "Success"}
 
 
@@ -62,23 +65,25 @@ async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(get
     user = await repository_users.get_user_by_email(email, db)
     if not secrets.compare_digest(user.refresh_token, token):
         await repository_users.update_token(user, None, db)
+        auth_service.token_cache.evict_subject(email)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=messages.INVALID_REFRESH_TOKEN)
 
     access_token = await auth_service.create_access_token(data={"sub": email})
     refresh_token_ = await auth_service.create_refresh_token(data={"sub": email})
     await repository_users.update_token(user, refresh_token_, db)
+    auth_service.token_cache.evict_subject(email)
     return {"access_token": access_token, "refresh_token": refresh_token_, "token_type": "bearer"}
 
 
 @router.post("/request_email")
-async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, request: Request,
+async def request_email(body: RequestEmail, request: Request,
                         db: AsyncSession = Depends(get_db)) -> dict:
     user = await repository_users.get_user_by_email(body.email, db)
 
     if user.confirmed:
         return {"message": messages.EMAIL_ALREADY_CONFIRMED}
     if user:
-        background_tasks.add_task(send_email, user.email, user.username, str(request.base_url))
+        await send_email(user.email, user.username, str(request.base_url))
     return {"message": messages.CHECK_EMAIL_FOR_CONFIRMATION}
 
 
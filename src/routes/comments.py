@@ -0,0 +1,53 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, status, Depends, Response, Query, Path
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.db import get_db, get_read_db
+from src.models.models import User, Role
+from src.services.auth import auth_service
+from src.schemas.comments import CommentCreateSchema, CommentReadSchema
+from src.repository import comments as repository_comments
+
+router = APIRouter(prefix='/comments', tags=['comment'])
+
+
+@router.get('/image/{image_id}', response_model=List[CommentReadSchema])
+async def get_image_comments(response: Response, image_id: int = Path(ge=1),
+                             limit: int = Query(20, ge=1, le=100),
+                             cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor header"),
+                             db: AsyncSession = Depends(get_read_db)):
+    comments, next_cursor = await repository_comments.get_image_comments(image_id, limit, db, cursor)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return comments
+
+
+@router.post('/{image_id}', response_model=CommentReadSchema, status_code=status.HTTP_201_CREATED)
+async def create_comment(body: CommentCreateSchema, image_id: int = Path(ge=1),
+                         user: User = Depends(auth_service.get_current_user),
+                         db: AsyncSession = Depends(get_db)):
+    comment = await repository_comments.create_comment(image_id, body.text, user, db)
+    if comment is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    return comment
+
+
+@router.put('/update/{comment_id}', response_model=CommentReadSchema)
+async def update_comment(body: CommentCreateSchema, comment_id: int = Path(ge=1),
+                         user: User = Depends(auth_service.get_current_user),
+                         db: AsyncSession = Depends(get_db)):
+    comment = await repository_comments.get_comment(comment_id, db)
+    if comment is None or comment.user_id != user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+    return await repository_comments.update_comment(comment, body.text, db)
+
+
+@router.delete('/delete/{comment_id}', status_code=status.HTTP_204_NO_CONTENT)
+async def delete_comment(comment_id: int = Path(ge=1),
+                         user: User = Depends(auth_service.get_current_user),
+                         db: AsyncSession = Depends(get_db)):
+    comment = await repository_comments.get_comment(comment_id, db)
+    if comment is None or (comment.user_id != user.id and user.role not in (Role.admin, Role.moderator)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+    await repository_comments.delete_comment(comment, db)
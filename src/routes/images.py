@@ -1,28 +1,78 @@
+import asyncio
+import os
+from datetime import datetime, timezone
 from typing import Optional, List
 
-from fastapi import UploadFile, APIRouter, HTTPException, status, Depends, File, Response, Form, Query, Path
+from fastapi import UploadFile, APIRouter, HTTPException, status, Depends, File, Response, Form, Query, Path, \
+    BackgroundTasks, Request
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import FileResponse
 
-from src.database.db import get_db
-from src.models.models import Image, User
+from src.database.db import get_db, get_read_db
+from src.models.models import Image, ImageVariant, User
 from src.conf.config import settings
 from src.services.auth import auth_service
-from src.schemas.images import ImageCreateSchema, ImageReadSchema
+from src.services.image import derivative_engine, PRESET_PATTERN
+from src.services import download as download_service
+from src.services.storage import storage
+from src.services.rate_limit import upload_limiter
+from src.services.serialization import dump_image_rows
+from src.services.response_cache import response_cache, CachedResponse, images_tag, tag_name_tag, owner_tag
+from src.schemas.images import ImageCreateSchema, ImageReadSchema, BatchUploadResultSchema, BulkTagRequestSchema, \
+    BulkTagResultSchema, SignedUrlSchema
 from src.repository import images as repository_images
 
 router = APIRouter(prefix='/images', tags=['image'])
 
 
+def set_next_cursor(response: Response, images, limit: int):
+    cursor = repository_images.next_cursor(images, limit)
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor
+
+
+# Serialized page of image rows for the response cache, tagged with the owners shown in it
+def cached_image_list(rows, limit: int) -> CachedResponse | None:
+    if not rows:
+        return None
+    cursor = repository_images.next_cursor(rows, limit)
+    return CachedResponse(dump_image_rows(rows), {'X-Next-Cursor': cursor} if cursor else {},
+                          list({owner_tag(row.owner_id) for row in rows}))
+
+
+def cached_response(cached: CachedResponse | None) -> Response:
+    if cached is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="NOT FOUND")
+    return Response(content=cached.body, media_type='application/json', headers=cached.headers)
+
+
 @router.get('/tag', response_model=List[ImageReadSchema])
-async def get_images_by_tag(tag_name: str = Query(description="Input tag", min_length=3, max_length=50),
+async def get_images_by_tag(request: Request, background_tasks: BackgroundTasks,
+                            tag_name: Optional[str] = Query(None, description="Input tag", min_length=3,
+                                                            max_length=50),
+                            tags: Optional[str] = Query(None, description="Tag expression, e.g. "
+                                                                          "'beach AND sunset NOT night OR sea'",
+                                                        max_length=1000),
                             limit: int = Query(10, ge=10, le=500), offset: int = Query(0, ge=0),
-                            db: AsyncSession = Depends(get_db)):
-    images = await repository_images.get_images_by_tag(tag_name, limit, offset, db)
-    if not images:
+                            cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor header"),
+                            db: AsyncSession = Depends(get_read_db)):
+    if bool(tag_name) == bool(tags):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Give either tag_name or tags")
+    # tag_name is a literal tag, only the tags parameter is an expression
+    groups = repository_images.parse_tag_expression(tags) if tags else [([tag_name], [])]
+    cache_tags = [tag_name_tag(name) for required, excluded in groups for name in required + excluded]
+    if not all(required for required, _ in groups):
+        # A group of exclusions only matches untagged images too
+        cache_tags.append(images_tag())
+
+    async def build(session: AsyncSession):
+        images = await repository_images.get_images_by_tag(groups, limit, offset, session, cursor)
+        return cached_image_list(images, limit)
+
+    cached = await response_cache.get_or_build(request, cache_tags, build, db, background_tasks)
+    if cached is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="TAG NOT EXISTS")
-    return images
+    return cached_response(cached)
 
 
 @router.post('/add_tag/{image_id}', response_model=ImageReadSchema)
@@ -36,48 +86,196 @@ async def add_tag_to_image(image_id: int = Path(ge=1),
     return result
 
 
-@router.get('/all', response_model=List[ImageReadSchema])
-async def get_images(limit: int = Query(10, ge=10, le=500), offset: int = Query(0, ge=0),
-                     db: AsyncSession = Depends(get_db)):
-    query = select(Image).offset(offset).limit(limit)
-    images = await repository_images.get_images(query, db)
+@router.get('/search', response_model=List[ImageReadSchema])
+async def search_images(response: Response,
+                        q: str = Query(description="Words to find in titles and comments, e.g. 'sunset -night'",
+                                       min_length=1, max_length=200),
+                        limit: int = Query(10, ge=10, le=500),
+                        cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor header"),
+                        db: AsyncSession = Depends(get_read_db)):
+    images, next_cursor = await repository_images.search_images(q, limit, db, cursor)
     if not images:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="NOT FOUND")
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
     return images
 
 
+@router.post('/add_tags', response_model=List[BulkTagResultSchema])
+async def add_tags_to_images(body: BulkTagRequestSchema,
+                             user: User = Depends(auth_service.get_current_user),
+                             db: AsyncSession = Depends(get_db)):
+    requested = {}
+    for item in body.items:
+        requested[item.image_id] = list(dict.fromkeys(requested.get(item.image_id, []) + item.tags))
+    # No image takes more than max_add_tags, so the rest is not even created as tags
+    image_tags = {image_id: tags[:settings.max_add_tags] for image_id, tags in requested.items()}
+    added = await repository_images.add_tags_to_images(image_tags, user, db)
+    return [{'image_id': image_id, 'added': added[image_id],
+             'skipped': [tag for tag in tags if tag not in added[image_id]]}
+            for image_id, tags in requested.items()]
+
+
+@router.get('/all', response_model=List[ImageReadSchema])
+async def get_images(request: Request, background_tasks: BackgroundTasks,
+                     limit: int = Query(10, ge=10, le=500), offset: int = Query(0, ge=0),
+                     cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor header"),
+                     db: AsyncSession = Depends(get_read_db)):
+    async def build(session: AsyncSession):
+        images = await repository_images.get_all_images(limit, offset, session, cursor)
+        return cached_image_list(images, limit)
+
+    cached = await response_cache.get_or_build(request, [images_tag()], build, db, background_tasks)
+    return cached_response(cached)
+
+
 @router.post("/upload", response_model=ImageReadSchema, status_code=status.HTTP_201_CREATED)
-async def upload_image(file: UploadFile = File(..., description="The image file to upload"),
+async def upload_image(request: Request, background_tasks: BackgroundTasks,
+                       file: UploadFile = File(..., description="The image file to upload"),
                        title: str = Form(min_length=3, max_length=50),
                        tag: Optional[str] = None,
                        user: User = Depends(auth_service.get_current_user),
                        db: AsyncSession = Depends(get_db)):
-    new_name = await repository_images.format_filename(file)
-    size_is_valid = await repository_images.get_file_size(file)
+    await upload_limiter.check(request, str(user.id))
     file_is_valid = await repository_images.file_is_image(file)
-    if size_is_valid > settings.max_image_size:
-        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                            detail=f"File too large. Max size is {settings.max_image_size} bytes")
     if not file_is_valid:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"File is not an image. Only images are allowed")
-    file_path = await repository_images.save_file_to_uploads(file, new_name)
+    stored_file = await repository_images.stream_file_to_uploads(file)
+    new_name = await repository_images.format_filename(file, stored_file.content_hash)
+    blob = await repository_images.save_blob(stored_file, new_name, db)
 
-    image = await repository_images.create_upload_image(name=new_name, size=size_is_valid, mime_type=file.content_type,
-                                                        file_path=file_path, title=title,
+    image = await repository_images.create_upload_image(name=os.path.basename(blob.path), size=blob.size,
+                                                        mime_type=blob.mime_type, file_path=blob.path,
+                                                        content_hash=blob.content_hash, title=title,
                                                         tag=tag, user=user, db=db)
+    if blob.ref_count == 1:
+        background_tasks.add_task(derivative_engine.generate_in_background, blob.content_hash, blob.path)
 
     return image
 
 
-@router.get('/download/{image_id}', status_code=status.HTTP_200_OK)
-async def download_image(image_id: int = Path(ge=1), db: AsyncSession = Depends(get_db)):
-    query = select(Image).filter_by(id=image_id)
+@router.post("/upload_batch", response_model=List[BatchUploadResultSchema], status_code=status.HTTP_201_CREATED)
+async def upload_images_batch(request: Request, background_tasks: BackgroundTasks,
+                              files: List[UploadFile] = File(..., description="The image files to upload"),
+                              titles: List[str] = Form(..., description="Title per file, in the same order"),
+                              tags: Optional[List[str]] = Form(None, description="Tag per file, empty for none"),
+                              user: User = Depends(auth_service.get_current_user),
+                              db: AsyncSession = Depends(get_db)):
+    tags = tags or [''] * len(files)
+    # A batch counts one upload per file, so it can't be larger than the upload rate limit either
+    max_files = min(settings.max_batch_files, upload_limiter.limit)
+    if len(files) > max_files:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"You can't upload more than {max_files} files at once")
+    if len(titles) != len(files) or len(tags) != len(files):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Titles and tags must be given for every file")
+    await upload_limiter.check(request, str(user.id), cost=len(files))
+
+    semaphore = asyncio.Semaphore(settings.upload_concurrency)
+
+    async def stream(file: UploadFile, title: str, tag: str):
+        if not 3 <= len(title) <= 50:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Title must be 3 to 50 characters")
+        if tag and not 3 <= len(tag) <= 50:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tag must be 3 to 50 characters")
+        if not await repository_images.file_is_image(file):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="File is not an image. Only images are allowed")
+        async with semaphore:
+            return await repository_images.stream_file_to_uploads(file)
+
+    stored_files = await asyncio.gather(*[stream(file, title, tag) for file, title, tag in zip(files, titles, tags)],
+                                        return_exceptions=True)
+    results = [{'filename': file.filename, 'image': None, 'detail': None} for file in files]
+    entries = []
+    for index, (stored_file, file) in enumerate(zip(stored_files, files)):
+        if isinstance(stored_file, repository_images.StoredFile):
+            new_name = await repository_images.format_filename(file, stored_file.content_hash)
+            entries.append((index, stored_file, new_name))
+        elif isinstance(stored_file, HTTPException):
+            results[index]['detail'] = stored_file.detail
+        else:
+            await repository_images.discard_stored_files([f for f in stored_files
+                                                          if isinstance(f, repository_images.StoredFile)])
+            raise stored_file
+    if not entries:
+        return results
+
+    blobs, written = await repository_images.save_blobs([(stored_file, new_name)
+                                                         for _, stored_file, new_name in entries], db)
+    items = []
+    for index, stored_file, _ in entries:
+        blob = blobs[stored_file.content_hash]
+        items.append({'name': os.path.basename(blob.path), 'size': blob.size, 'mime_type': blob.mime_type,
+                      'title': titles[index], 'file_path': blob.path, 'content_hash': blob.content_hash,
+                      'tag': tags[index] or None})
+    images = await repository_images.create_upload_images(items, user, db)
+    for (index, _, _), image in zip(entries, images):
+        results[index]['image'] = image
+    for content_hash in written:
+        background_tasks.add_task(derivative_engine.generate_in_background, content_hash, blobs[content_hash].path)
+    return results
+
+
+# The image and, for a size, its derivative to send; variant is None for the original
+async def get_download_target(image_id: int, size: Optional[str],
+                              db: AsyncSession) -> tuple[Image, Optional[ImageVariant]]:
+    query = select(Image).filter_by(id=image_id).options(*repository_images.IMAGE_FILE_OPTIONS)
     image = await repository_images.get_image(query, db)
-    if image:
-        return FileResponse(image.image_path, media_type="image/png", filename=image.name)
-    else:
+    if not image:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    variant = None
+    if size and image.content_hash:
+        variant = await repository_images.get_variant(image.content_hash, size, db)
+    return image, variant
+
+
+@router.get('/download/{image_id}', status_code=status.HTTP_200_OK)
+async def download_image(request: Request, image_id: int = Path(ge=1),
+                         size: Optional[str] = Query(None, pattern=PRESET_PATTERN,
+                                                     description="Derivative preset, original when omitted"),
+                         db: AsyncSession = Depends(get_read_db)):
+    image, variant = await get_download_target(image_id, size, db)
+    target = variant or image
+    key = variant.path if variant else image.image_path
+    filename = os.path.basename(variant.path) if variant else image.name
+    etag = download_service.image_etag(image, variant)
+    headers = download_service.cache_headers(etag, target.updated_at)
+    if download_service.is_not_modified(request.headers, etag, target.updated_at):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    byte_range = download_service.requested_range(request.headers, etag, target.size)
+    return await download_service.storage_response(key, target.size, byte_range, headers, target.mime_type,
+                                                   filename)
+
+
+# Expiring link for a signed-in user to a file that is served without touching the database (by the proxy or
+# /files/); the link itself is the authorization, so it can be passed on until it expires
+@router.get('/signed_url/{image_id}', response_model=SignedUrlSchema)
+async def get_signed_url(request: Request, image_id: int = Path(ge=1),
+                         size: Optional[str] = Query(None, pattern=PRESET_PATTERN,
+                                                     description="Derivative preset, original when omitted"),
+                         user: User = Depends(auth_service.get_current_user),
+                         db: AsyncSession = Depends(get_read_db)):
+    image, variant = await get_download_target(image_id, size, db)
+    key = variant.path if variant else image.image_path
+    filename = os.path.basename(variant.path) if variant else image.name
+    if storage.local_path(key) is None:
+        url = await storage.presign(key, expires=settings.signed_url_expires, filename=filename)
+        expires = int(datetime.now(timezone.utc).timestamp()) + settings.signed_url_expires
+    else:
+        url, expires = download_service.signed_file_url(key, filename)
+        url = str(request.base_url).rstrip('/') + url
+    return {'url': url, 'expires_at': datetime.fromtimestamp(expires, timezone.utc)}
+
+
+@router.get('/files/{key:path}', include_in_schema=False)
+async def get_signed_file(request: Request, key: str, expires: int = Query(), filename: str = Query(),
+                          signature: str = Query()):
+    if not download_service.verify_file_signature(key, expires, filename, signature):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Link is invalid or expired")
+    return await download_service.signed_file_response(request.headers, key, filename)
 
 
 @router.delete('/delete/{image_id}', status_code=status.HTTP_204_NO_CONTENT)
@@ -88,9 +286,9 @@ async def delete_image(image_id: int = Path(ge=1),
     image = await repository_images.get_image(query, db)
     if image:
         # Delete image from DB
-        await repository_images.delete_image_from_db(image, db)
+        file_paths = await repository_images.delete_image_from_db(image, db)
         # Delete file from uploads
-        await repository_images.delete_image_from_uploads(image.name)
+        await repository_images.delete_image_from_uploads(image, file_paths, db)
         return {'ditail': f'File {image.name} successfully deleted'}
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
@@ -112,10 +310,13 @@ async def update_image(image_id: int = Path(ge=1),
 
 @router.get('/', response_model=list[ImageReadSchema])
 async def get_images_by_user(limit: int = Query(10, ge=10, le=500), offset: int = Query(0, ge=0),
-                             db: AsyncSession = Depends(get_db),
+                             cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor header"),
+                             db: AsyncSession = Depends(get_read_db),
                              user: User = Depends(auth_service.get_current_user)):
-    query = select(Image).filter_by(owner_id=user.id).offset(offset).limit(limit)
-    images = await repository_images.get_images(query, db)
-    if not images:
+    query = repository_images.paginate(select(Image).filter_by(owner_id=user.id), limit, offset, cursor)
+    rows = await repository_images.get_image_rows(query, db)
+    if not rows:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="NOT FOUND")
-    return images
+    response = Response(content=dump_image_rows(rows), media_type='application/json')
+    set_next_cursor(response, rows, limit)
+    return response
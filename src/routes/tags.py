@@ -0,0 +1,17 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.db import get_read_db
+from src.repository import tags as repository_tags
+from src.schemas.tags import TagSuggestionSchema
+
+router = APIRouter(prefix='/tags', tags=['tag'])
+
+
+@router.get('/suggest', response_model=List[TagSuggestionSchema])
+async def suggest_tags(prefix: str = Query(description="Beginning of the tag", min_length=1, max_length=50),
+                       limit: int = Query(10, ge=1, le=50),
+                       db: AsyncSession = Depends(get_read_db)):
+    return await repository_tags.suggest_tags(prefix, limit, db)
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from pydantic import BaseModel, Field, ConfigDict
+
+from src.schemas.user import UserReadSchema
+
+
+class CommentCreateSchema(BaseModel):
+    text: str = Field(min_length=1, max_length=1000)
+
+
+class CommentReadSchema(BaseModel):
+    id: int
+    text: str
+    image_id: int
+    created_at: datetime
+    updated_at: datetime
+    user: UserReadSchema
+
+    model_config = ConfigDict(from_attributes=True)
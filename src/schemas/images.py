@@ -1,9 +1,10 @@
-from typing import Optional, List
+from typing import Optional, List, Annotated
 from datetime import datetime
 from typing import Optional
 
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
 
+from src.conf.config import settings
 from src.models.models import Tag
 from src.schemas.user import UserReadSchema
 
@@ -16,6 +17,7 @@ class ImageReadSchema(BaseModel):
     created_at: datetime
     updated_at: datetime
     count_tags: Optional[int] = 0
+    comment_count: Optional[int] = 0
     owner: UserReadSchema
 
     model_config = ConfigDict(from_attributes=True)
@@ -27,5 +29,31 @@ class ImageCreateSchema(BaseModel):
     title: str
     image_path: str
     mime_type: str
+    content_hash: Optional[str] = None
 
 
+class BatchUploadResultSchema(BaseModel):
+    filename: str
+    image: Optional[ImageReadSchema] = None
+    detail: Optional[str] = None
+
+
+class ImageTagsSchema(BaseModel):
+    image_id: int = Field(ge=1)
+    tags: List[Annotated[str, Field(min_length=3, max_length=50)]] = Field(min_length=1,
+                                                                           max_length=settings.max_add_tags)
+
+
+class BulkTagRequestSchema(BaseModel):
+    items: List[ImageTagsSchema] = Field(min_length=1, max_length=1000)
+
+
+class BulkTagResultSchema(BaseModel):
+    image_id: int
+    added: List[str]
+    skipped: List[str]
+
+
+class SignedUrlSchema(BaseModel):
+    url: str
+    expires_at: datetime
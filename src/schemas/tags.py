@@ -0,0 +1,8 @@
+from pydantic import BaseModel, ConfigDict
+
+
+class TagSuggestionSchema(BaseModel):
+    name: str
+    usage_count: int
+
+    model_config = ConfigDict(from_attributes=True)
@@ -1,6 +1,14 @@
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from src.conf.config import settings
+from src.conf import messages
+from src.services import metrics
 
 from fastapi import Depends, HTTPException, status
 from passlib.context import CryptContext
@@ -13,17 +21,95 @@ from src.repository import users as repository_users
 from src.models.models import User
 
 
+# bcrypt calls run in the password hash executor, so they live at module level to be picklable
+def _verify_password(plain_password, hashed_password) -> bool:
+    return Auth.pwd_context.verify(plain_password, hashed_password)
+
+
+def _get_password_hash(password: str) -> str:
+    return Auth.pwd_context.hash(password)
+
+
+# Bounded LRU of verified access token payloads, kept until the token expires; stats are exported on /metrics
+class TokenCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._payloads: OrderedDict[str, dict] = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._key(token)
+        payload = self._payloads.get(key)
+        if payload is not None and payload['exp'] > time.time():
+            self._payloads.move_to_end(key)
+            metrics.TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+            return payload
+        if payload is not None:
+            del self._payloads[key]
+            metrics.TOKEN_CACHE_SIZE.set(len(self._payloads))
+        metrics.TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+        return None
+
+    def set(self, token: str, payload: dict):
+        if self.maxsize <= 0:
+            return
+        self._payloads[self._key(token)] = payload
+        self._payloads.move_to_end(self._key(token))
+        while len(self._payloads) > self.maxsize:
+            self._payloads.popitem(last=False)
+        metrics.TOKEN_CACHE_SIZE.set(len(self._payloads))
+
+    # Drop every cached token of the user, e.g. on logout or refresh token rotation
+    def evict_subject(self, email: str):
+        for key in [key for key, payload in self._payloads.items() if payload['sub'] == email]:
+            del self._payloads[key]
+        metrics.TOKEN_CACHE_SIZE.set(len(self._payloads))
+
+
 class Auth:
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     SECRET_KEY = settings.secret_key
     ALGORITHM = settings.algorithm
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
+    token_cache = TokenCache(settings.token_cache_size)
+    _hash_executor: Executor | None = None
+    _hash_pending: int = 0
+
+    @property
+    def hash_executor(self) -> Executor:
+        if self._hash_executor is None:
+            workers = settings.password_hash_workers or None
+            if settings.password_hash_executor == 'thread':
+                Auth._hash_executor = ThreadPoolExecutor(max_workers=workers)
+            else:
+                Auth._hash_executor = ProcessPoolExecutor(max_workers=workers,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+        return self._hash_executor
+
+    def shutdown_hash_executor(self):
+        if self._hash_executor is not None:
+            self._hash_executor.shutdown(wait=False, cancel_futures=True)
+            Auth._hash_executor = None
+
+    # Run bcrypt off the event loop; reject with 503 when too many calls are already queued
+    async def _run_hashing(self, func, *args):
+        if Auth._hash_pending >= settings.password_hash_queue_size:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=messages.SERVER_BUSY,
+                                headers={"Retry-After": str(settings.password_hash_retry_after)})
+        Auth._hash_pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.hash_executor, func, *args)
+        finally:
+            Auth._hash_pending -= 1
 
-    def verify_password(self, plain_password, hashed_password) -> bool:
-        return self.pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(self, plain_password, hashed_password) -> bool:
+        return await self._run_hashing(_verify_password, plain_password, hashed_password)
 
-    def get_password_hash(self, password: str) -> str:
-        return self.pwd_context.hash(password)
+    async def get_password_hash(self, password: str) -> str:
+        return await self._run_hashing(_get_password_hash, password)
 
     # define a function to generate a new access token
     async def create_access_token(self, data: dict, expires_delta: Optional[float] = None):
@@ -64,28 +150,36 @@ class Auth:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-        try:
-            # Decode JWT
-            payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
-            if payload['scope'] == 'access_token':
-                email = payload.get("sub")
-                if email is None:
+        payload = self.token_cache.get(token)
+        if payload is None:
+            try:
+                # Decode JWT
+                payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+                if payload['scope'] == 'access_token':
+                    email = payload.get("sub")
+                    if email is None:
+                        raise credentials_exception
+                else:
                     raise credentials_exception
-            else:
+            except JWTError as e:
                 raise credentials_exception
+            self.token_cache.set(token, payload)
 
-            email = payload["sub"]
-            if email is None:
-                raise credentials_exception
-        except JWTError as e:
-            raise credentials_exception
+        email = payload["sub"]
+
+        # A cached snapshot exists only for users with an active refresh token
+        user = await repository_users.get_cached_user(email)
+        if user is not None:
+            return user
 
+        generation = await repository_users.get_user_generation(email)
         user = await repository_users.get_user_by_email(email, db)
         if user is None:
             raise credentials_exception
 
         if user.refresh_token is None:
             raise credentials_exception
+        await repository_users.cache_user(user, generation)
         return user
 
     async def create_email_token(self, data: dict):
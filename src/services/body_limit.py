@@ -0,0 +1,36 @@
+from fastapi import HTTPException, status
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# Caps request bodies per path before FastAPI parses them: a declared Content-Length over the limit is
+# refused without reading the body, and a body without one (chunked) is cut off as soon as it passes the limit
+class BodySizeLimitMiddleware:
+    def __init__(self, app: ASGIApp, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        limit = self.limits.get(scope['path']) if scope['type'] == 'http' else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        detail = f"Request body too large. Max size is {limit} bytes"
+        content_length = Headers(scope=scope).get('content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = ORJSONResponse({'detail': detail}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                      headers={'Connection': 'close'})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # FastAPI re-raises HTTPException from body parsing, so this becomes the response
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,225 @@
+import calendar
+import hashlib
+import hmac
+import mimetypes
+import os
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, urlencode
+
+import anyio
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from src.conf.config import settings
+from src.models.models import Image, ImageVariant
+from src.services.storage import storage
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# Strong validator: the content hash when known, size and update time for images saved before dedup
+def image_etag(image: Image, variant: ImageVariant | None = None) -> str:
+    if variant is not None:
+        return f'"{variant.content_hash}-{variant.preset}-{variant.presets_version}"'
+    if image.content_hash is not None:
+        return f'"{image.content_hash}"'
+    return f'"{image.size}-{int(image.updated_at.timestamp())}"'
+
+
+def http_date(value: datetime) -> str:
+    return formatdate(calendar.timegm(value.timetuple()), usegmt=True)
+
+
+def cache_headers(etag: str, last_modified: datetime) -> dict:
+    return {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': settings.image_cache_control,
+    }
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+# If-None-Match wins over If-Modified-Since (RFC 9110, 13.2.2)
+def is_not_modified(headers: Headers, etag: str, last_modified: datetime) -> bool:
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        return modified <= since.astimezone(timezone.utc)
+    return False
+
+
+# Single byte range requested by the client as (start, end) inclusive, None to send the whole file
+def requested_range(headers: Headers, etag: str, size: int) -> tuple[int, int] | None:
+    range_header = headers.get('range')
+    if range_header is None:
+        return None
+    if_range = headers.get('if-range')
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        # Multiple or unknown ranges: ignoring Range is allowed
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail="Requested range not satisfiable", headers={'Content-Range': f'bytes */{size}'})
+    return start, end
+
+
+# FileResponse that can send a single byte range as 206 Partial Content
+class RangeFileResponse(FileResponse):
+    def __init__(self, path: str, byte_range: tuple[int, int] | None = None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.headers.setdefault('accept-ranges', 'bytes')
+        self.byte_range = byte_range
+        if byte_range is not None:
+            self.status_code = status.HTTP_206_PARTIAL_CONTENT
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.byte_range is None:
+            return await super().__call__(scope, receive, send)
+        start, end = self.byte_range
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            raise RuntimeError(f"File at path {self.path} does not exist.")
+        self.headers['content-range'] = f'bytes {start}-{end}/{stat_result.st_size}'
+        self.headers['content-length'] = str(end - start + 1)
+        self.set_stat_headers(stat_result)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                if remaining > 0:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.background is not None:
+            await self.background()
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+# Empty response naming the file for the front proxy to send; the proxy answers Range requests itself
+def offload_response(path: str, headers: dict, media_type: str | None, filename: str) -> Response:
+    if settings.file_offload == 'x-accel':
+        offload_header = {'X-Accel-Redirect': settings.file_offload_prefix + quote(path.lstrip('/'))}
+    elif settings.file_offload == 'x-sendfile':
+        offload_header = {'X-Sendfile': os.path.abspath(path)}
+    else:
+        raise ValueError(f"Unknown FILE_OFFLOAD '{settings.file_offload}', use x-accel or x-sendfile")
+    headers = headers | offload_header | {'Content-Disposition': content_disposition(filename)}
+    return Response(headers=headers, media_type=media_type or mimetypes.guess_type(filename)[0])
+
+
+def file_response(path: str, byte_range: tuple[int, int] | None, headers: dict, media_type: str | None,
+                  filename: str) -> Response:
+    if settings.file_offload:
+        return offload_response(path, headers, media_type, filename)
+    return RangeFileResponse(path, byte_range=byte_range, headers=headers, media_type=media_type, filename=filename)
+
+
+# Local files are sent from disk (or by the proxy); remote objects by a redirect to a presigned URL or proxied
+async def storage_response(key: str, size: int, byte_range: tuple[int, int] | None, headers: dict, media_type: str,
+                           filename: str) -> Response:
+    local_path = storage.local_path(key)
+    if local_path is not None:
+        return file_response(local_path, byte_range, headers, media_type, filename)
+    if settings.storage_presigned_downloads:
+        url = await storage.presign(key, filename=filename)
+        if url is not None:
+            return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+                                    headers={'Cache-Control': 'no-store'})
+    start, end = byte_range or (0, size - 1)
+    headers = headers | {'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1),
+                         'Content-Disposition': content_disposition(filename)}
+    status_code = status.HTTP_200_OK
+    if byte_range is not None:
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+    return StreamingResponse(storage.stream(key, start, end), status_code=status_code, headers=headers,
+                             media_type=media_type)
+
+
+# Never the JWT key itself: whoever validates links (e.g. nginx with njs) must not be able to mint tokens
+def signed_url_key() -> bytes:
+    if settings.signed_url_secret:
+        return settings.signed_url_secret.encode()
+    return hmac.new(settings.secret_key.encode(), b'file-url', hashlib.sha256).digest()
+
+
+# signature = hex HMAC-SHA256(key, "<key>\n<expires>\n<filename>"), so a proxy holding SIGNED_URL_SECRET
+# can check a link as well as the app, neither needs the database
+def file_signature(key: str, expires: int, filename: str) -> str:
+    return hmac.new(signed_url_key(), f'{key}\n{expires}\n{filename}'.encode(), hashlib.sha256).hexdigest()
+
+
+# Relative URL under SIGNED_URL_PREFIX for a stored file and the unix time it expires at
+def signed_file_url(key: str, filename: str, expires_in: int | None = None) -> tuple[str, int]:
+    expires = int(time.time()) + (expires_in or settings.signed_url_expires)
+    query = urlencode({'expires': expires, 'filename': filename,
+                       'signature': file_signature(key, expires, filename)})
+    return f'{settings.signed_url_prefix}{quote(key)}?{query}', expires
+
+
+def verify_file_signature(key: str, expires: int, filename: str, signature: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(file_signature(key, expires, filename), signature)
+
+
+# Serve a signed link from the file itself: validators come from the file stat instead of the database row
+async def signed_file_response(request_headers: Headers, key: str, filename: str) -> Response:
+    local_path = storage.local_path(key)
+    if local_path is None:
+        url = await storage.presign(key, filename=filename)
+        if url is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+        return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+                                headers={'Cache-Control': 'no-store'})
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, local_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    last_modified = datetime.fromtimestamp(stat_result.st_mtime, timezone.utc)
+    etag = f'"{stat_result.st_size}-{int(stat_result.st_mtime)}"'
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request_headers, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    byte_range = requested_range(request_headers, etag, stat_result.st_size)
+    return file_response(local_path, byte_range, headers, None, filename)
@@ -1,10 +1,16 @@
+import json
+import uuid
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
 from pathlib import Path
-from src.conf.config import settings
 
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
-from fastapi_mail.errors import ConnectionErrors
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
 from pydantic import EmailStr
+from redis.exceptions import RedisError
 
+from src.conf.config import settings
+from src.database.db import db_redis
 from src.services.auth import auth_service
 
 conf = ConnectionConfig(
@@ -12,45 +18,68 @@ conf = ConnectionConfig(
     MAIL_PASSWORD=settings.mail_password,
     MAIL_FROM=settings.mail_from,
     MAIL_PORT=settings.mail_port,
-    MAIL_SERVER="smtp.meta.ua",
+    MAIL_SERVER=settings.mail_server,
     MAIL_FROM_NAME=settings.mail_from,
-    MAIL_STARTTLS=False,
-    MAIL_SSL_TLS=True,
-    USE_CREDENTIALS=True,
+    MAIL_STARTTLS=settings.mail_starttls,
+    MAIL_SSL_TLS=settings.mail_ssl_tls,
+    USE_CREDENTIALS=settings.mail_use_credentials,
     VALIDATE_CERTS=True,
     TEMPLATE_FOLDER=Path(__file__).parent / 'templates',
 )
 
+# Jobs are pushed on the left of MAIL_QUEUE and taken from the right by scripts/email_worker.py
+MAIL_QUEUE = 'mail:queue'
+MAIL_RETRY = 'mail:retry'
+MAIL_DEAD = 'mail:dead'
 
-async def send_email(email: EmailStr, username: str, host: str):
+template_env = conf.template_engine()
+
+
+def build_message(job: dict) -> EmailMessage:
+    html = template_env.get_template(job['template_name']).render(**job['template_body'])
+    message = EmailMessage()
+    message['Subject'] = job['subject']
+    message['From'] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message['To'] = job['recipient']
+    # Generated once at enqueue time, so retries reuse it and receivers can drop duplicates
+    message['Message-ID'] = job.get('message_id') or make_msgid(idstring=job['id'])
+    message.set_content(html, subtype='html')
+    return message
+
+
+async def open_smtp() -> aiosmtplib.SMTP:
+    smtp = aiosmtplib.SMTP(hostname=conf.MAIL_SERVER, port=conf.MAIL_PORT, use_tls=conf.MAIL_SSL_TLS,
+                           start_tls=conf.MAIL_STARTTLS, validate_certs=conf.VALIDATE_CERTS, timeout=conf.TIMEOUT)
+    await smtp.connect()
+    if conf.USE_CREDENTIALS:
+        await smtp.login(conf.MAIL_USERNAME, conf.MAIL_PASSWORD.get_secret_value())
+    return smtp
+
+
+async def enqueue_email(subject: str, recipient: str, template_name: str, template_body: dict):
+    job_id = uuid.uuid4().hex
+    job = {'id': job_id, 'message_id': make_msgid(idstring=job_id), 'subject': subject, 'recipient': recipient,
+           'template_name': template_name, 'template_body': template_body, 'attempts': 0}
     try:
-        token_verification = await auth_service.create_email_token({"sub": email})
-
-        message = MessageSchema(
-            subject="Confirm your email ",
-            recipients=[email],
-            template_body={"host": host, "username": username, "token": token_verification},
-            subtype=MessageType.html
-        )
-
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="email_template.html")
-    except ConnectionErrors as err:
+        await db_redis.lpush(MAIL_QUEUE, json.dumps(job))
+    except RedisError as err:
         print(err)
+        # Without the queue send from this process, as before
+        try:
+            smtp = await open_smtp()
+            await smtp.send_message(build_message(job))
+            await smtp.quit()
+        except (aiosmtplib.SMTPException, OSError) as err:
+            print(err)
+
+
+async def send_email(email: EmailStr, username: str, host: str):
+    token_verification = await auth_service.create_email_token({"sub": email})
+    await enqueue_email("Confirm your email ", email, "email_template.html",
+                        {"host": host, "username": username, "token": token_verification})
 
 
 async def send_email_reset_password(email: EmailStr, username: str, host: str):
-    try:
-        token_verification = await auth_service.create_email_token({"sub": email})
-
-        message = MessageSchema(
-            subject="Reset password ",
-            recipients=[email],
-            template_body={"host": host, "username": username, "token": token_verification},
-            subtype=MessageType.html
-        )
-
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="password_template.html")
-    except ConnectionErrors as err:
-        print(err)
+    token_verification = await auth_service.create_email_token({"sub": email})
+    await enqueue_email("Reset password ", email, "password_template.html",
+                        {"host": host, "username": username, "token": token_verification})
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import random
+import time
+
+import aiosmtplib
+from jinja2 import TemplateError
+from redis.exceptions import RedisError
+
+from src.conf.config import settings
+from src.database.db import db_redis
+from src.services.email import MAIL_QUEUE, MAIL_RETRY, MAIL_DEAD, build_message, open_smtp
+
+# Move retries that are due back to the queue
+PROMOTE_RETRIES_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('LPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+
+class PermanentFailure(Exception):
+    pass
+
+
+# SMTP connections kept open between batches; idle ones are checked with NOOP before reuse
+class SMTPPool:
+    def __init__(self, size: int):
+        self._size = size
+        self._opened = 0
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    # Raises TimeoutError (an OSError, so the job is retried) when no connection is ready in time
+    async def acquire(self) -> aiosmtplib.SMTP:
+        return await asyncio.wait_for(self._acquire(), settings.mail_smtp_acquire_timeout)
+
+    async def _acquire(self) -> aiosmtplib.SMTP:
+        while True:
+            if self._idle.empty() and self._opened < self._size:
+                self._opened += 1
+                try:
+                    return await open_smtp()
+                except BaseException:
+                    self._opened -= 1
+                    # The slot is free again: let a waiter try to open it
+                    self._idle.put_nowait((None, 0))
+                    raise
+            smtp, released_at = await self._idle.get()
+            if smtp is None:
+                continue
+            if smtp.is_connected and (time.monotonic() - released_at < settings.mail_smtp_idle_timeout
+                                      or await self._alive(smtp)):
+                return smtp
+            self._opened -= 1
+            smtp.close()
+
+    @staticmethod
+    async def _alive(smtp: aiosmtplib.SMTP) -> bool:
+        try:
+            await smtp.noop()
+            return True
+        except (aiosmtplib.SMTPException, OSError):
+            return False
+
+    def release(self, smtp: aiosmtplib.SMTP, broken: bool = False):
+        if broken or not smtp.is_connected:
+            self._opened -= 1
+            smtp.close()
+            # Free slot marker: wakes up a waiter so it opens a new connection
+            self._idle.put_nowait((None, 0))
+            return
+        self._idle.put_nowait((smtp, time.monotonic()))
+
+    async def close(self):
+        while not self._idle.empty():
+            smtp, _ = self._idle.get_nowait()
+            if smtp is None:
+                continue
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+            self._opened -= 1
+
+
+# Reliable queue: jobs are moved to a per-worker processing list and removed only once delivered,
+# rescheduled or dead-lettered, so a crashed worker's jobs are requeued when it starts again
+class EmailWorker:
+    _promote_retries = db_redis.register_script(PROMOTE_RETRIES_SCRIPT)
+
+    def __init__(self, name: str):
+        self.processing = f'mail:processing:{name}'
+        self.pool = SMTPPool(settings.mail_smtp_connections)
+        self.stopping = asyncio.Event()
+
+    async def recover(self) -> int:
+        recovered = 0
+        while await db_redis.rpoplpush(self.processing, MAIL_QUEUE) is not None:
+            recovered += 1
+        return recovered
+
+    async def fetch_batch(self) -> list[str]:
+        first = await db_redis.brpoplpush(MAIL_QUEUE, self.processing, timeout=1)
+        if first is None:
+            return []
+        batch = [first]
+        while len(batch) < settings.mail_batch_size:
+            raw = await db_redis.rpoplpush(MAIL_QUEUE, self.processing)
+            if raw is None:
+                break
+            batch.append(raw)
+        return batch
+
+    async def send(self, job: dict):
+        try:
+            message = build_message(job)
+        except TemplateError as err:
+            raise PermanentFailure(err)
+        smtp = await self.pool.acquire()
+        try:
+            await smtp.send_message(message)
+        except aiosmtplib.SMTPRecipientsRefused as err:
+            self.pool.release(smtp)
+            if all(500 <= recipient.code for recipient in err.recipients):
+                raise PermanentFailure(err)
+            raise
+        except aiosmtplib.SMTPResponseException as err:
+            self.pool.release(smtp)
+            if 500 <= err.code:
+                raise PermanentFailure(err)
+            raise
+        except BaseException:
+            self.pool.release(smtp, broken=True)
+            raise
+        self.pool.release(smtp)
+
+    # A job that fails in any other way (bad JSON, missing fields, a bug) is dead-lettered as is,
+    # so it can't crash the worker and be requeued by recover() on every restart
+    async def handle(self, raw: str):
+        try:
+            await self.process(raw)
+        except RedisError:
+            raise
+        except Exception as err:
+            error = f'{type(err).__name__}: {err}'
+            async with db_redis.pipeline(transaction=True) as pipe:
+                pipe.lpush(MAIL_DEAD, json.dumps({'raw': raw, 'error': error, 'failed_at': time.time()}))
+                pipe.lrem(self.processing, 1, raw)
+                await pipe.execute()
+            print(f"Dead-lettered job {raw[:200]!r}: {error}")
+
+    async def process(self, raw: str):
+        job = json.loads(raw)
+        try:
+            await self.send(job)
+            await db_redis.lrem(self.processing, 1, raw)
+            return
+        except PermanentFailure as err:
+            error, permanent = str(err), True
+        except (aiosmtplib.SMTPException, OSError) as err:
+            error, permanent = str(err), False
+        job['attempts'] += 1
+        job['error'] = error
+        async with db_redis.pipeline(transaction=True) as pipe:
+            if permanent or job['attempts'] >= settings.mail_max_attempts:
+                job['failed_at'] = time.time()
+                pipe.lpush(MAIL_DEAD, json.dumps(job))
+            else:
+                delay = min(settings.mail_retry_base * 2 ** (job['attempts'] - 1), settings.mail_retry_max)
+                pipe.zadd(MAIL_RETRY, {json.dumps(job): time.time() + delay * random.uniform(0.5, 1)})
+            pipe.lrem(self.processing, 1, raw)
+            await pipe.execute()
+        print(f"{job['id']} to {job['recipient']}: attempt {job['attempts']} failed: {error}")
+
+    async def run(self):
+        recovered = await self.recover()
+        if recovered:
+            print(f"Requeued {recovered} unfinished jobs")
+        try:
+            while not self.stopping.is_set():
+                await self._promote_retries(keys=[MAIL_RETRY, MAIL_QUEUE],
+                                            args=[time.time(), settings.mail_batch_size * 10])
+                batch = await self.fetch_batch()
+                await asyncio.gather(*[self.handle(raw) for raw in batch])
+        finally:
+            await self.pool.close()
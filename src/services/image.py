@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from PIL import Image as PILImage, ImageOps
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import settings
+from src.database.db import sessionmanager
+from src.repository import images as repository_images
+from src.services.storage import storage
+
+# Derivatives built for every uploaded blob; changing them changes PRESETS_VERSION
+DERIVATIVE_PRESETS = {
+    'thumb': {'max_size': 256, 'format': 'JPEG', 'quality': 80},
+    'medium': {'max_size': 1024, 'format': 'JPEG', 'quality': 85},
+    'web': {'max_size': 2048, 'format': 'WEBP', 'quality': 80},
+}
+PRESETS_VERSION = hashlib.sha1(json.dumps(DERIVATIVE_PRESETS, sort_keys=True).encode()).hexdigest()[:12]
+PRESET_PATTERN = f"^({'|'.join(DERIVATIVE_PRESETS)})$"
+
+FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+
+# Runs in a worker process: resize the original into every preset, written to output_dir;
+# 'file' is the rendered file, 'path' the storage key it goes to
+def render_variants(source_path: str, content_hash: str, output_dir: str) -> list[dict]:
+    variants = []
+    with PILImage.open(source_path) as original:
+        original = ImageOps.exif_transpose(original)
+        for preset, options in DERIVATIVE_PRESETS.items():
+            variant = original.copy()
+            variant.thumbnail((options['max_size'], options['max_size']))
+            if options['format'] == 'JPEG' and variant.mode not in ('RGB', 'L'):
+                variant = variant.convert('RGB')
+            ext, mime_type = FORMATS[options['format']]
+            filename = f'{content_hash}_{preset}{ext}'
+            file_path = os.path.join(output_dir, filename)
+            variant.save(file_path, options['format'], quality=options['quality'], optimize=True)
+            variants.append({'preset': preset, 'path': f'{settings.uploaded_files_path}{filename}',
+                             'file': file_path, 'width': variant.width, 'height': variant.height,
+                             'size': os.path.getsize(file_path), 'mime_type': mime_type})
+    return variants
+
+
+class DerivativeEngine:
+    _executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            DerivativeEngine._executor = ProcessPoolExecutor(max_workers=settings.image_workers or None,
+                                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            DerivativeEngine._executor = None
+
+    # Render the variants of the original stored under key and put them in storage next to it
+    async def render(self, content_hash: str, key: str) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        os.makedirs(settings.uploaded_files_path, exist_ok=True)
+        async with storage.local_copy(key) as source_path:
+            with tempfile.TemporaryDirectory(dir=settings.uploaded_files_path) as output_dir:
+                variants = await loop.run_in_executor(self.executor, render_variants, source_path, content_hash,
+                                                      output_dir)
+                for variant in variants:
+                    await storage.put(variant['path'], variant.pop('file'), variant['mime_type'])
+        return variants
+
+    async def generate(self, content_hash: str, key: str, db: AsyncSession):
+        variants = await self.render(content_hash, key)
+        await repository_images.save_variants(content_hash, variants, PRESETS_VERSION, db)
+
+    # Upload-time entry point for BackgroundTasks: the request session is already closed
+    async def generate_in_background(self, content_hash: str, key: str):
+        try:
+            async with sessionmanager.session() as db:
+                await self.generate(content_hash, key, db)
+        except Exception as err:
+            print(err)
+
+    # Rebuild variants of every blob made with other presets; returns the number of blobs processed
+    async def regenerate_outdated(self, db: AsyncSession, batch_size: int = 100) -> int:
+        processed = 0
+        after = None
+        while True:
+            blobs = await repository_images.get_blobs_with_outdated_variants(PRESETS_VERSION,
+                                                                             len(DERIVATIVE_PRESETS),
+                                                                             batch_size, db, after)
+            if not blobs:
+                return processed
+            # Render the whole batch in the pool, then save sequentially on the single session
+            results = await asyncio.gather(*[self.render(blob.content_hash, blob.path) for blob in blobs],
+                                           return_exceptions=True)
+            for blob, variants in zip(blobs, results):
+                if isinstance(variants, Exception):
+                    print(f"{blob.content_hash}: {variants}")
+                    continue
+                await repository_images.save_variants(blob.content_hash, variants, PRESETS_VERSION, db)
+            processed += len(blobs)
+            after = blobs[-1].content_hash
+
+
+derivative_engine = DerivativeEngine()
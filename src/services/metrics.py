@@ -0,0 +1,130 @@
+import os
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, \
+    generate_latest
+from prometheus_client import multiprocess
+from redis.asyncio import Redis
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by route',
+                            ['method', 'route'])
+REQUESTS = Counter('http_requests_total', 'Requests by route and status', ['method', 'route', 'status'])
+DB_STATEMENTS = Counter('db_statements_total', 'SQL statements executed by route', ['engine', 'route'])
+DB_STATEMENT_LATENCY = Histogram('db_statement_duration_seconds', 'SQL statement time by route',
+                                 ['engine', 'route'], buckets=DB_BUCKETS)
+POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections in use', ['engine'], multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('db_pool_overflow', 'Connections open above pool_size', ['engine'],
+                      multiprocess_mode='livesum')
+POOL_WAITING = Gauge('db_pool_waiting', 'Callers waiting for a connection', ['engine'],
+                     multiprocess_mode='livesum')
+POOL_WAIT = Histogram('db_pool_wait_seconds', 'Time to get a connection from the pool', ['engine'],
+                      buckets=DB_BUCKETS)
+REDIS_LATENCY = Histogram('redis_command_duration_seconds', 'Redis command latency', ['command'],
+                          buckets=DB_BUCKETS)
+UPLOAD_BYTES = Counter('upload_bytes_total', 'Bytes of uploaded files', ['result'])
+UPLOAD_FILES = Counter('upload_files_total', 'Uploaded files', ['result'])
+TOKEN_CACHE_LOOKUPS = Counter('token_cache_lookups_total', 'Access token cache lookups', ['result'])
+TOKEN_CACHE_SIZE = Gauge('token_cache_size', 'Verified access tokens cached', multiprocess_mode='livesum')
+
+# ASGI scope of the request being served; the matched route is added to it by the router
+current_scope: ContextVar[Scope | None] = ContextVar('current_scope', default=None)
+
+
+def route_label(scope: Scope | None) -> str:
+    if scope is None:
+        return 'background'
+    route = scope.get('route')
+    return route.path if route is not None else 'unmatched'
+
+
+# Pure ASGI middleware: the route is only known after routing, so labels are read from the scope at the end
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status_code = 500
+        token = current_scope.set(scope)
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_label(scope)
+            REQUEST_LATENCY.labels(scope['method'], route).observe(time.perf_counter() - started)
+            REQUESTS.labels(scope['method'], route, str(status_code)).inc()
+            current_scope.reset(token)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        engine_name = getattr(self, '_metrics_name', 'unnamed')
+        POOL_WAITING.labels(engine_name).inc()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.labels(engine_name).observe(time.perf_counter() - started)
+            POOL_WAITING.labels(engine_name).dec()
+
+
+# Statement counts and timings per route, pool gauges on every checkout and checkin
+def instrument_engine(engine: Engine, name: str):
+    engine.pool._metrics_name = name
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        route = route_label(current_scope.get())
+        DB_STATEMENTS.labels(name, route).inc()
+        DB_STATEMENT_LATENCY.labels(name, route).observe(elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        if exception_context.connection is not None and exception_context.connection.info.get('query_started'):
+            exception_context.connection.info['query_started'].pop()
+
+    def update_pool_gauges(*args):
+        POOL_CHECKED_OUT.labels(name).set(engine.pool.checkedout())
+        POOL_OVERFLOW.labels(name).set(max(engine.pool.overflow(), 0))
+
+    event.listen(engine.pool, 'checkout', update_pool_gauges)
+    event.listen(engine.pool, 'checkin', update_pool_gauges)
+
+
+class InstrumentedRedis(Redis):
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - started)
+
+
+# With several worker processes PROMETHEUS_MULTIPROC_DIR must be set so that any worker reports all of them
+def metrics_response() -> Response:
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
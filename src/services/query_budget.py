@@ -0,0 +1,95 @@
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.conf.config import settings
+
+# Bind parameter lists of any length look the same: "IN ($1, $2, $3)" -> "IN (?)"
+PARAMETERS_PATTERN = re.compile(r'\$\d+(?:\s*,\s*\$\d+)*')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement: str, elapsed: float):
+        self.count += 1
+        self.time += elapsed
+        self.shapes[PARAMETERS_PATTERN.sub('?', statement)] += 1
+
+    # Reasons the request is over budget, empty when it is not
+    def violations(self, route: str) -> list[str]:
+        problems = []
+        budget = settings.query_budgets.get(route, settings.query_budget)
+        if self.count > budget:
+            problems.append(f"{self.count} statements, budget is {budget}")
+        for shape, repeats in self.shapes.items():
+            if repeats > settings.query_budget_repeats:
+                problems.append(f"statement run {repeats} times: {shape}")
+        return problems
+
+
+current_stats: ContextVar[QueryStats | None] = ContextVar('current_stats', default=None)
+
+
+# Listeners do nothing outside requests served through QueryBudgetMiddleware
+def track_queries(engine: Engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_stats.get() is not None:
+            conn.info.setdefault('budget_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats.get()
+        if stats is not None and conn.info.get('budget_started'):
+            stats.add(statement, time.perf_counter() - conn.info['budget_started'].pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('budget_started'):
+            connection.info['budget_started'].pop()
+
+
+# Opt-in with QUERY_BUDGET_ENABLED; QUERY_BUDGET_MODE=raise fails the request, for the test suite
+class QueryBudgetMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = QueryStats()
+        token = current_stats.set(stats)
+
+        async def send_wrapper(message: Message):
+            if message['type'] == 'http.response.start':
+                route = scope['route'].path if scope.get('route') is not None else scope['path']
+                problems = stats.violations(route)
+                if problems:
+                    report = f"Query budget exceeded on {scope['method']} {route}: " + '; '.join(problems)
+                    if settings.query_budget_mode == 'raise':
+                        raise QueryBudgetExceeded(report)
+                    print(report)
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-db-queries', str(stats.count).encode()),
+                    (b'x-db-time', f'{stats.time * 1000:.2f}'.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_stats.reset(token)
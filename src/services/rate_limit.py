@@ -0,0 +1,114 @@
+import math
+import time
+import uuid
+from collections import deque
+
+from fastapi import HTTPException, Request, status
+from redis.exceptions import RedisError
+
+from src.conf import messages
+from src.conf.config import settings
+from src.database.db import db_redis
+
+# Sliding window log over every key at once: either all keys accept the cost hits or none records them.
+# Returns 0 when allowed, otherwise milliseconds until enough hits of the fullest key leave the window.
+SLIDING_WINDOW_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local cost = tonumber(ARGV[4])
+local retry_after = 0
+for _, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    local count = redis.call('ZCARD', key)
+    if count + cost > limit then
+        -- The hit that has to leave the window so that cost more fit
+        local index = count + cost - limit - 1
+        if index >= count then
+            retry_after = math.max(retry_after, window)
+        else
+            local oldest = redis.call('ZRANGE', key, index, index, 'WITHSCORES')
+            retry_after = math.max(retry_after, tonumber(oldest[2]) + window - now)
+        end
+    end
+end
+if retry_after > 0 then
+    return retry_after
+end
+for _, key in ipairs(KEYS) do
+    for i = 1, cost do
+        redis.call('ZADD', key, now, ARGV[3] .. ':' .. i)
+    end
+    redis.call('PEXPIRE', key, window)
+end
+return 0
+"""
+
+# In-process windows are pruned when there are more keys than this
+LOCAL_MAX_KEYS = 10000
+# After a Redis error only the in-process limiter is used for this many seconds
+REDIS_RETRY_INTERVAL = 5
+
+
+def parse_rate(rate: str) -> tuple[int, int]:
+    limit, seconds = rate.split('/')
+    return int(limit), int(seconds)
+
+
+class RateLimiter:
+    _script = db_redis.register_script(SLIDING_WINDOW_SCRIPT)
+    _redis_down_until = 0.0
+
+    def __init__(self, name: str, rate: str):
+        self.name = name
+        self.limit, self.window = parse_rate(rate)
+        self._local: dict[str, deque] = {}
+
+    def _keys(self, request: Request, user_key: str | None) -> list[str]:
+        keys = [f'rate:{self.name}:ip:{request.client.host if request.client else ""}']
+        if user_key:
+            keys.append(f'rate:{self.name}:user:{user_key.lower()}')
+        return keys
+
+    # Fallback when Redis is down: same window, but counted per process
+    def _hit_local(self, keys: list[str], cost: int) -> float:
+        now = time.monotonic()
+        if len(self._local) > LOCAL_MAX_KEYS:
+            self._local = {key: hits for key, hits in self._local.items() if hits and hits[-1] > now - self.window}
+        retry_after = 0.0
+        for key in keys:
+            hits = self._local.setdefault(key, deque())
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) + cost > self.limit:
+                index = len(hits) + cost - self.limit - 1
+                retry_after = max(retry_after, hits[index] + self.window - now if index < len(hits) else self.window)
+        if retry_after == 0:
+            for key in keys:
+                self._local[key].extend([now] * cost)
+        return retry_after
+
+    async def _hit(self, keys: list[str], cost: int) -> float:
+        if time.monotonic() < RateLimiter._redis_down_until:
+            return self._hit_local(keys, cost)
+        try:
+            retry_after_ms = await self._script(keys=keys, args=[self.window * 1000, self.limit, uuid.uuid4().hex,
+                                                                 cost])
+            return retry_after_ms / 1000
+        except RedisError as err:
+            print(err)
+            RateLimiter._redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+            return self._hit_local(keys, cost)
+
+    # Counts cost hits (one per request by default) for the client IP and, when given, the user or account it targets
+    async def check(self, request: Request, user_key: str | None = None, cost: int = 1):
+        retry_after = await self._hit(self._keys(request, user_key), cost)
+        if retry_after > 0:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=messages.TOO_MANY_REQUESTS,
+                                headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+
+login_limiter = RateLimiter('login', settings.rate_limit_login)
+signup_limiter = RateLimiter('signup', settings.rate_limit_signup)
+upload_limiter = RateLimiter('upload', settings.rate_limit_upload)
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from typing import Awaitable, Callable, NamedTuple
+from urllib.parse import urlencode
+
+from fastapi import BackgroundTasks, Request
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import settings
+from src.database.db import db_redis, sessionmanager
+
+# Delete the stampede lock only if this request still owns it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+LOCK_POLL_INTERVAL = 0.05
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    headers: dict
+    # Tags known only from the result, e.g. owners of the listed images
+    tags: list[str] = []
+
+
+def images_tag() -> str:
+    return 'images'
+
+
+def tag_name_tag(name: str) -> str:
+    return f'tag:{name}'
+
+
+def owner_tag(owner_id) -> str:
+    return f'owner:{owner_id}'
+
+
+# JSON bodies in Redis, invalidated by bumping per-tag version counters: an entry is valid while the
+# versions it was built with are current. Expired entries are served stale while one request rebuilds.
+class ResponseCache:
+    _release_lock = db_redis.register_script(RELEASE_LOCK_SCRIPT)
+
+    def cache_key(self, request: Request) -> str:
+        params = urlencode(sorted(request.query_params.multi_items()))
+        return 'cache:' + hashlib.sha1(f'{request.url.path}?{params}'.encode()).hexdigest()
+
+    async def _versions(self, tags: list[str]) -> dict[str, str]:
+        if not tags:
+            return {}
+        values = await db_redis.mget([f'cache:version:{tag}' for tag in tags])
+        return {tag: value or '0' for tag, value in zip(tags, values)}
+
+    # Entry and its state: 'fresh', 'stale' (expired but inside the stale window) or 'invalid'
+    async def _read(self, key: str) -> tuple[dict | None, str | None]:
+        entry = await db_redis.hgetall(key)
+        if not entry:
+            return None, None
+        versions = json.loads(entry['versions'])
+        if await self._versions(list(versions)) != versions:
+            return entry, 'invalid'
+        return entry, 'fresh' if float(entry['fresh_until']) > time.time() else 'stale'
+
+    async def _acquire_lock(self, key: str) -> str | None:
+        token = uuid.uuid4().hex
+        if await db_redis.set(f'{key}:lock', token, nx=True, ex=settings.response_cache_lock_timeout):
+            return token
+        return None
+
+    async def _store(self, key: str, cached: CachedResponse, versions: dict):
+        versions = versions | await self._versions([tag for tag in cached.tags if tag not in versions])
+        async with db_redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={'body': cached.body.decode(), 'headers': json.dumps(cached.headers),
+                                    'versions': json.dumps(versions),
+                                    'fresh_until': time.time() + settings.response_cache_ttl})
+            pipe.expire(key, settings.response_cache_ttl + settings.response_cache_stale)
+            await pipe.execute()
+
+    # Built on the primary: after a write bumps the versions, a lagging replica could still return
+    # the old rows and they would be stored as current for the whole TTL
+    async def _rebuild(self, key: str, tags: list[str], build, token: str) -> CachedResponse | None:
+        try:
+            versions = await self._versions(tags)
+            async with sessionmanager.session() as db:
+                cached = await build(db)
+            if cached is not None:
+                await self._store(key, cached, versions)
+            return cached
+        finally:
+            await self._release_lock(keys=[f'{key}:lock'], args=[token])
+
+    async def _refresh_in_background(self, key: str, tags: list[str], build, token: str):
+        try:
+            await self._rebuild(key, tags, build, token)
+        except Exception as err:
+            print(err)
+
+    @staticmethod
+    def _response(entry: dict) -> CachedResponse:
+        return CachedResponse(entry['body'].encode(), json.loads(entry['headers']))
+
+    # Cached response for the request, built with build(db) on a miss; None when build finds nothing.
+    # db (may be a replica) only serves requests that bypass the cache, e.g. while Redis is down
+    async def get_or_build(self, request: Request, tags: list[str],
+                           build: Callable[[AsyncSession], Awaitable[CachedResponse | None]],
+                           db: AsyncSession, background_tasks: BackgroundTasks) -> CachedResponse | None:
+        key = self.cache_key(request)
+        try:
+            entry, state = await self._read(key)
+            if state == 'fresh':
+                return self._response(entry)
+            token = await self._acquire_lock(key)
+            if state == 'stale':
+                if token:
+                    background_tasks.add_task(self._refresh_in_background, key, tags, build, token)
+                return self._response(entry)
+            if token:
+                return await self._rebuild(key, tags, build, token)
+            # Someone else is rebuilding: the replaced copy is good enough meanwhile, else wait for theirs
+            if entry is not None:
+                return self._response(entry)
+            deadline = time.monotonic() + settings.response_cache_lock_timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+                entry, state = await self._read(key)
+                if state == 'fresh':
+                    return self._response(entry)
+        except RedisError as err:
+            print(err)
+        return await build(db)
+
+    async def invalidate(self, *tags: str):
+        try:
+            async with db_redis.pipeline(transaction=False) as pipe:
+                for tag in set(tags):
+                    pipe.incr(f'cache:version:{tag}')
+                await pipe.execute()
+        except RedisError as err:
+            print(err)
+
+
+response_cache = ResponseCache()
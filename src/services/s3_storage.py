@@ -0,0 +1,98 @@
+from typing import AsyncIterator
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+
+from src.conf.config import settings
+from src.services.storage import Storage, STREAM_CHUNK_SIZE, discard_file
+
+MISSING_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+# Amazon S3 or any S3-compatible store (MinIO, Ceph, R2) through S3_ENDPOINT_URL.
+# boto3 runs in threads; its transfer manager uploads and downloads big files as parallel multipart parts.
+class S3Storage(Storage):
+    name = 's3'
+
+    def __init__(self):
+        self.bucket = settings.s3_bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=settings.s3_endpoint_url or None,
+            region_name=settings.s3_region or None,
+            aws_access_key_id=settings.s3_access_key or None,
+            aws_secret_access_key=settings.s3_secret_key or None,
+            config=Config(max_pool_connections=settings.storage_max_concurrency * 2,
+                          s3={'addressing_style': 'path' if settings.s3_endpoint_url else 'auto'}),
+        )
+        self.transfer_config = TransferConfig(multipart_threshold=settings.storage_multipart_chunk_size,
+                                              multipart_chunksize=settings.storage_multipart_chunk_size,
+                                              max_concurrency=settings.storage_max_concurrency)
+
+    @staticmethod
+    def _is_missing(err: ClientError) -> bool:
+        return err.response.get('Error', {}).get('Code') in MISSING_CODES
+
+    async def put(self, key: str, file_path: str, content_type: str):
+        try:
+            await run_in_threadpool(self.client.upload_file, file_path, self.bucket, key,
+                                    ExtraArgs={'ContentType': content_type}, Config=self.transfer_config)
+        finally:
+            await run_in_threadpool(discard_file, file_path)
+
+    async def _get_object(self, key: str, **kwargs) -> dict:
+        try:
+            return await run_in_threadpool(self.client.get_object, Bucket=self.bucket, Key=key, **kwargs)
+        except ClientError as err:
+            if self._is_missing(err):
+                raise FileNotFoundError(key) from err
+            raise
+
+    async def get(self, key: str) -> bytes:
+        response = await self._get_object(key)
+        body = response['Body']
+        try:
+            return await run_in_threadpool(body.read)
+        finally:
+            body.close()
+
+    async def stream(self, key: str, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+        byte_range = f'bytes={start}-{"" if end is None else end}'
+        response = await self._get_object(key, Range=byte_range)
+        body = response['Body']
+        try:
+            async for chunk in iterate_in_threadpool(body.iter_chunks(STREAM_CHUNK_SIZE)):
+                yield chunk
+        finally:
+            body.close()
+
+    async def download(self, key: str, file_path: str):
+        try:
+            await run_in_threadpool(self.client.download_file, self.bucket, key, file_path,
+                                    Config=self.transfer_config)
+        except ClientError as err:
+            if self._is_missing(err):
+                raise FileNotFoundError(key) from err
+            raise
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await run_in_threadpool(self.client.head_object, Bucket=self.bucket, Key=key)
+        except ClientError as err:
+            if self._is_missing(err):
+                return False
+            raise
+        return True
+
+    async def presign(self, key: str, expires: int | None = None, filename: str | None = None) -> str | None:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if filename:
+            params['ResponseContentDisposition'] = f'attachment; filename="{filename}"'
+        return await run_in_threadpool(self.client.generate_presigned_url, 'get_object', Params=params,
+                                       ExpiresIn=expires or settings.storage_presign_expires)
@@ -0,0 +1,29 @@
+import uuid
+
+import orjson
+
+# Same fields and order as ImageReadSchema and its nested UserReadSchema
+IMAGE_FIELDS = ('id', 'title', 'image_path', 'mime_type', 'created_at', 'updated_at', 'count_tags', 'comment_count')
+OWNER_FIELDS = ('id', 'email', 'username', 'avatar', 'role')
+
+
+# asyncpg returns its own UUID subclass, which orjson only encodes through a default
+def encode_default(value) -> str:
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError
+
+
+# JSON array of ImageReadSchema from rows of IMAGE_ROW_COLUMNS without building models;
+# every owner is encoded once and its bytes reused for all of their images on the page
+def dump_image_rows(rows) -> bytes:
+    owners = {}
+    parts = []
+    for row in rows:
+        owner = owners.get(row.owner_id)
+        if owner is None:
+            owner = owners[row.owner_id] = orjson.dumps({field: getattr(row, f'owner_{field}')
+                                                        for field in OWNER_FIELDS}, default=encode_default)
+        image = orjson.dumps({field: getattr(row, field) for field in IMAGE_FIELDS}, default=encode_default)
+        parts.append(image[:-1] + b',"owner":' + owner + b'}')
+    return b'[' + b','.join(parts) + b']'
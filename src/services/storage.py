@@ -0,0 +1,137 @@
+import contextlib
+import os
+from abc import ABC, abstractmethod
+import shutil
+import tempfile
+from typing import AsyncIterator
+
+import anyio
+from starlette.concurrency import run_in_threadpool
+
+from src.conf.config import settings
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Where image files live. Keys are the paths stored in the database (e.g. "uploaded_files/<hash>.jpg"),
+# so the same key addresses a file on disk, an S3 object or a Cloudinary asset.
+class Storage(ABC):
+    name = ''
+
+    # Path on this node's disk, None when the objects live elsewhere
+    def local_path(self, key: str) -> str | None:
+        return None
+
+    # Store the file under key; the file at file_path is moved or removed
+    @abstractmethod
+    async def put(self, key: str, file_path: str, content_type: str):
+        ...
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes:
+        ...
+
+    # Bytes from start to end inclusive, the whole object by default
+    @abstractmethod
+    def stream(self, key: str, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+        ...
+
+    @abstractmethod
+    async def download(self, key: str, file_path: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    # Time-limited URL the client can fetch the object from directly, None if the app must serve it
+    async def presign(self, key: str, expires: int | None = None, filename: str | None = None) -> str | None:
+        return None
+
+    # Local file with the object content for tools that need a path, e.g. Pillow
+    @contextlib.asynccontextmanager
+    async def local_copy(self, key: str):
+        path = self.local_path(key)
+        if path is not None:
+            yield path
+            return
+        tmp_path = await make_temp_file()
+        try:
+            await self.download(key, tmp_path)
+            yield tmp_path
+        finally:
+            await run_in_threadpool(discard_file, tmp_path)
+
+
+def discard_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def make_temp_file(suffix: str = '.part') -> str:
+    await run_in_threadpool(os.makedirs, settings.uploaded_files_path, exist_ok=True)
+    fd, tmp_path = await run_in_threadpool(tempfile.mkstemp, suffix=suffix, dir=settings.uploaded_files_path)
+    os.close(fd)
+    return tmp_path
+
+
+class LocalStorage(Storage):
+    name = 'local'
+
+    def local_path(self, key: str) -> str | None:
+        return key
+
+    @staticmethod
+    def _move(file_path: str, key: str):
+        os.makedirs(os.path.dirname(key) or '.', exist_ok=True)
+        shutil.move(file_path, key)
+
+    async def put(self, key: str, file_path: str, content_type: str):
+        await run_in_threadpool(self._move, file_path, key)
+
+    async def get(self, key: str) -> bytes:
+        async with await anyio.open_file(key, mode='rb') as file:
+            return await file.read()
+
+    async def stream(self, key: str, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+        async with await anyio.open_file(key, mode='rb') as file:
+            await file.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = await file.read(STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    async def download(self, key: str, file_path: str):
+        await run_in_threadpool(shutil.copyfile, key, file_path)
+
+    async def delete(self, key: str):
+        await run_in_threadpool(discard_file, key)
+
+    async def exists(self, key: str) -> bool:
+        return await run_in_threadpool(os.path.exists, key)
+
+
+# Backends other than local import their SDK only when selected
+def create_storage(name: str) -> Storage:
+    if name == 'local':
+        return LocalStorage()
+    if name == 's3':
+        from src.services.s3_storage import S3Storage
+        return S3Storage()
+    if name == 'cloudinary':
+        from src.services.cloudinary_storage import CloudinaryStorage
+        return CloudinaryStorage()
+    raise ValueError(f"Unknown storage backend '{name}', use local, s3 or cloudinary")
+
+
+storage = create_storage(settings.storage_backend)